@@ -0,0 +1,1118 @@
+"""Benchmarks for Jyle's hot paths.
+
+Run one with:  python bench.py <name>
+Run them all:  python bench.py
+
+Every benchmark talks to a local fake OpenAI server, so no API key or
+network access is needed.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'bench')
+os.environ.setdefault('OPENAI_API_KEY', 'sk-bench')
+
+import numpy as np
+from aiohttp import web
+from openai import OpenAI
+
+import main
+
+for noisy in ("httpx", "discord", "main"):
+    logging.getLogger(noisy).setLevel(logging.ERROR)
+# The fake server logs an error for every reply whose client already hung up (cancelled hedges)
+logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+
+
+class FakeOpenAIServer:
+    """Tiny stand-in for the OpenAI chat completions endpoint, run on its own thread"""
+    def __init__(self, latency=0.05, reply="Bench reply from the fake Jyle backend 💅", token_delay=0.0):
+        self.latency = latency
+        self.reply = reply
+        self.token_delay = token_delay  # pause between streamed tokens
+        self.requests = 0
+        self.fail_next = 0  # answer this many upcoming requests with fail_status
+        self.fail_status = 429
+        self.stall_rate = 0.0  # fraction of requests that stall for stall_time before answering
+        self.stall_time = 0.0
+        self.responder = None  # optional callable(body) -> reply text
+        self.prompt_tokens = []  # (json mode, estimated prompt tokens) per request
+        self.recent_prompts = []  # serialized prompts, to simulate provider prefix caching
+        self.key_limits = {}  # api key -> requests allowed per key_window (other keys are unlimited)
+        self.key_window = 1.0
+        self.key_log = {}  # api key -> deque of request timestamps
+        self.revoked_keys = set()
+        self.throttled = 0
+        self.streamed_tokens = 0  # tokens generated, up to the point a streaming client hangs up
+        self.port = None
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def reply_for(self, body):
+        return self.responder(body) if self.responder else self.reply
+
+    def usage(self, body):
+        """Token usage, with cached_tokens for the longest prefix shared with a recent prompt"""
+        prompt = json.dumps(body.get("messages", []), ensure_ascii=False)
+        shared = max((len(os.path.commonprefix([prompt, earlier])) for earlier in self.recent_prompts), default=0)
+        self.recent_prompts = (self.recent_prompts + [prompt])[-8:]
+        prompt_tokens = len(prompt.encode()) // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": 20,
+            "total_tokens": prompt_tokens + 20,
+            "prompt_tokens_details": {"cached_tokens": shared // 4}
+        }
+
+    def rate_limit(self, api_key):
+        """x-ratelimit-* headers for a request on api_key, or None if it is over its limit"""
+        limit = self.key_limits.get(api_key)
+        if limit is None:
+            return {}
+        now = time.monotonic()
+        log = self.key_log.setdefault(api_key, deque())
+        while log and now - log[0] > self.key_window:
+            log.popleft()
+        if len(log) >= limit:
+            return None
+        log.append(now)
+        return {
+            "x-ratelimit-limit-requests": str(limit),
+            "x-ratelimit-remaining-requests": str(limit - len(log)),
+            "x-ratelimit-reset-requests": f"{self.key_window}s",
+        }
+
+    def completion(self, body):
+        """Build a chat.completion payload for a request body"""
+        return {
+            "id": f"chatcmpl-bench-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.reply_for(body)},
+                "finish_reason": "stop"
+            }],
+            "usage": self.usage(body)
+        }
+
+    def chunk(self, body, content):
+        """Build a chat.completion.chunk payload carrying one piece of the reply"""
+        return {
+            "id": f"chatcmpl-bench-{self.requests}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-3.5-turbo"),
+            "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+        }
+
+    async def handle_chat(self, request):
+        body = await request.json()
+        self.requests += 1
+        self.prompt_tokens.append((
+            body.get("response_format", {}).get("type") == "json_object",
+            sum(main.estimate_tokens(message["content"]) for message in body.get("messages", []))
+        ))
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            return web.json_response(
+                {"error": {"message": "fake failure", "type": "bench", "code": None}},
+                status=self.fail_status,
+                headers={"retry-after-ms": "50"}
+            )
+        api_key = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if api_key in self.revoked_keys:
+            return web.json_response(
+                {"error": {"message": "Incorrect API key provided", "type": "invalid_request_error", "code": "invalid_api_key"}},
+                status=401
+            )
+        headers = self.rate_limit(api_key)
+        if headers is None:
+            self.throttled += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"retry-after-ms": "100"}
+            )
+        await asyncio.sleep(self.latency)
+        if random.random() < self.stall_rate:
+            await asyncio.sleep(self.stall_time)
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_delay * len(self.reply.split(" ")))
+            self.streamed_tokens += len(self.reply.split(" "))
+            return web.json_response(self.completion(body), headers=headers)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **headers})
+        await response.prepare(request)
+        try:
+            for token in self.reply_for(body).split(" "):
+                await response.write(f"data: {json.dumps(self.chunk(body, token + ' '))}\n\n".encode())
+                self.streamed_tokens += 1
+                await asyncio.sleep(self.token_delay)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                final = {**self.chunk(body, ""), "choices": [], "usage": self.usage(body)}
+                await response.write(f"data: {json.dumps(final)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            pass  # the client hung up - stop generating
+        return response
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.handle_chat)
+        runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(runner.cleanup())
+        self._loop.close()
+
+
+class FakeMessage:
+    def __init__(self, content=None, embed=None):
+        self.content = content
+        self.embed = embed
+        self.edits = 0
+        self.deleted = False
+
+    async def edit(self, content=None, embed=None):
+        self.content = content
+        self.embed = embed
+        self.edits += 1
+
+    async def delete(self):
+        self.deleted = True
+
+
+class FakeContext:
+    """Minimal stand-in for a discord.py command context"""
+    ids = iter(range(1, 1 << 62))
+
+    def __init__(self, user_id=1, guild_id=1, channel_id=1, name="bench", command=None):
+        self.author = SimpleNamespace(id=user_id, display_name=name)
+        self.message = SimpleNamespace(id=next(self.ids))
+        self.command = SimpleNamespace(name=command) if command else None
+        self.guild = SimpleNamespace(id=guild_id)
+        self.channel = SimpleNamespace(id=channel_id)
+        self.sent = []
+
+    async def send(self, content=None, embed=None):
+        message = FakeMessage(content, embed)
+        self.sent.append((time.perf_counter(), message))
+        return message
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class HashingEmbedder:
+    """Deterministic local embedding: hashed word and character-trigram features
+    
+    Cheap and dependency free - a stand-in for a real embedding model in benchmarks.
+    It is a bag of words, so it can't tell "10 miles to km" from "10 km to miles".
+    """
+    STOP_WORDS = {
+        'a', 'an', 'the', 'is', 'are', 'was', 'what', 'whats', 's', 'can', 'could', 'you', 'me',
+        'please', 'explain', 'tell', 'about', 'how', 'do', 'does', 'of', 'to', 'i', 'jyle'
+    }
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    async def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        words = [word.rstrip('s') if len(word) > 3 else word for word in re.findall(r"[a-z0-9]+", text.lower())]
+        for word in words:
+            if word in self.STOP_WORDS:
+                continue
+            features = [word] + [word[i:i + 3] for i in range(max(1, len(word) - 2))]
+            for weight, feature in zip([2.0] + [1.0] * len(features), features):
+                digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], 'little') % self.dim
+                vector[bucket] += weight if digest[4] & 1 else -weight
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+def fake_ctx(user_id=1, guild_id=1, channel_id=1, name="bench", command=None):
+    return FakeContext(user_id, guild_id, channel_id, name, command)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def drive(call, total, concurrency):
+    """Run `call` total times with at most `concurrency` in flight; return (elapsed, latencies)"""
+    latencies = []
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with gate:
+            started = time.perf_counter()
+            await call(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return time.perf_counter() - started, latencies
+
+
+def report(label, elapsed, latencies):
+    print(f"  {label:<28} {len(latencies) / elapsed:8.1f} req/s   "
+          f"p50 {percentile(latencies, 50) * 1000:7.1f} ms   p99 {percentile(latencies, 99) * 1000:7.1f} ms")
+
+
+def bench_async_client(total=1000, concurrency=200, latency=0.05):
+    """Pooled AsyncOpenAI path vs. the old sync client wrapped in asyncio.to_thread"""
+    print(f"async_client: {total} completions, {concurrency} concurrent, {latency * 1000:.0f} ms server latency")
+    with FakeOpenAIServer(latency=latency) as server:
+        messages = [{"role": "user", "content": "bench: explain recursion"}]
+
+        async def run_to_thread():
+            client = OpenAI(api_key='sk-bench', base_url=server.base_url)
+
+            async def call(i):
+                await asyncio.to_thread(
+                    client.chat.completions.create,
+                    model="gpt-3.5-turbo",
+                    messages=messages,
+                    max_tokens=500,
+                    temperature=0.9
+                )
+            try:
+                return await drive(call, total, concurrency)
+            finally:
+                client.close()
+
+        async def run_async():
+            os.environ['OPENAI_BASE_URL'] = server.base_url
+            bot = main.AIDiscordBot()
+            ctx = fake_ctx()
+
+            async def call(i):
+                await bot.get_jyle_response(list(messages), "bench", "1", ctx)
+            try:
+                return await drive(call, total, concurrency)
+            finally:
+                await bot.openai_client.close()
+
+        report("to_thread (sync client)", *asyncio.run(run_to_thread()))
+        report("AsyncOpenAI (pooled)", *asyncio.run(run_async()))
+
+
+def bench_streaming(runs=5, latency=0.3, token_delay=0.02):
+    """Time to first visible text: streamed progressive edits vs. waiting for the full completion"""
+    reply = " ".join(["Recursion is when a function calls itself until it hits a base case."] * 8)
+    print(f"streaming: {len(reply.split())} tokens, {latency * 1000:.0f} ms to first token, {token_delay * 1000:.0f} ms/token")
+    with FakeOpenAIServer(latency=latency, reply=reply, token_delay=token_delay) as server:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def run(stream):
+            bot = main.AIDiscordBot()
+            bot.stream_responses = stream
+            first_visible, total, edits = [], [], 0
+            try:
+                for i in range(runs):
+                    ctx = fake_ctx(channel_id=i)
+                    started = time.perf_counter()
+                    streamed = bot.streaming_reply(ctx)
+                    text = await bot.get_jyle_response(
+                        [{"role": "user", "content": "bench: explain recursion"}], "bench", str(i), ctx,
+                        on_delta=streamed.update if stream else None
+                    )
+                    await streamed.finish(text)
+                    total.append(time.perf_counter() - started)
+                    first_visible.append(ctx.sent[0][0] - started)
+                    edits += sum(message.edits for _, message in ctx.sent)
+            finally:
+                await bot.openai_client.close()
+            return first_visible, total, edits
+
+        for label, stream in (("full completion", False), ("streamed edits", True)):
+            first_visible, total, edits = asyncio.run(run(stream))
+            print(f"  {label:<28} first text p50 {percentile(first_visible, 50) * 1000:7.1f} ms   "
+                  f"done p50 {percentile(total, 50) * 1000:7.1f} ms   {edits / runs:.1f} edits/reply")
+
+
+def bench_fair_queue(meme_requests=200, classrooms=10, limit=4, service=0.05):
+    """Latency for quiet guilds while one guild floods the queue: FIFO vs. per-guild fair queueing"""
+    print(f"fair_queue: 1 guild sends {meme_requests} at once, {classrooms} quiet guilds send 1 each, "
+          f"{limit} slots, {service * 1000:.0f} ms per completion")
+
+    async def run(fair):
+        controller = main.AdmissionController(
+            limit=limit, max_queue=10_000, max_wait=600, max_queue_per_key=10_000
+        )
+        latencies = {'meme': [], 'classroom': []}
+
+        async def request(guild_id, kind):
+            started = time.perf_counter()
+            async with controller.slot(guild_id if fair else None):
+                await asyncio.sleep(service)
+            latencies[kind].append(time.perf_counter() - started)
+
+        async def classroom(guild_id):
+            await asyncio.sleep(random.uniform(0, meme_requests * service / limit / 2))
+            await request(guild_id, 'classroom')
+
+        await asyncio.gather(
+            *(request(0, 'meme') for _ in range(meme_requests)),
+            *(classroom(guild_id) for guild_id in range(1, classrooms + 1))
+        )
+        return latencies
+
+    for label, fair in (("FIFO (arrival order)", False), ("deficit round-robin", True)):
+        random.seed(7)
+        latencies = asyncio.run(run(fair))
+        print(f"  {label:<24} quiet guilds p50 {percentile(latencies['classroom'], 50) * 1000:7.1f} ms "
+              f"p99 {percentile(latencies['classroom'], 99) * 1000:7.1f} ms   "
+              f"busy guild p50 {percentile(latencies['meme'], 50) * 1000:7.1f} ms")
+
+
+def bench_hedging(total=600, concurrency=20, latency=0.05, stall_rate=0.03, stall_time=2.0):
+    """Tail latency with occasional stalled completions, with and without request hedging"""
+    print(f"hedging: {total} completions, {stall_rate:.0%} stall for {stall_time * 1000:.0f} ms")
+    with FakeOpenAIServer(latency=latency) as server:
+        server.stall_rate = stall_rate
+        server.stall_time = stall_time
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def run(hedge):
+            bot = main.AIDiscordBot()
+            bot.hedging.enabled = hedge
+            bot.admission.limit = concurrency
+            ctx = fake_ctx()
+
+            async def call(i):
+                await bot.get_jyle_response([{"role": "user", "content": f"bench: explain closures #{i}"}], "bench", "1", ctx)
+            try:
+                elapsed, latencies = await drive(call, total, concurrency)
+            finally:
+                await bot.close()
+            return elapsed, latencies, bot.hedging
+
+        for label, hedge in (("no hedging", False), ("hedged at p95", True)):
+            random.seed(11)
+            elapsed, latencies, hedging = asyncio.run(run(hedge))
+            report(label, elapsed, latencies)
+            if hedge:
+                print(f"  {'':<28} {hedging.hedge_rate:.1%} of requests hedged, hedge won {hedging.win_rate:.0%}")
+
+
+def bench_response_cache(total=2000, distinct=300, max_entries=200, seed=3):
+    """Exact-match cache on a skewed stream of repeated !question prompts (deterministic for a seed)"""
+    print(f"response_cache: {total} !question prompts drawn from {distinct} (Zipf-like), cache holds {max_entries}")
+    with FakeOpenAIServer(latency=0.0) as server:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def run():
+            rng = random.Random(seed)
+            bot = main.AIDiscordBot()
+            bot.response_cache.max_entries = max_entries
+            bot.semantic_cache_enabled = False  # measure the exact-match layer on its own
+            weights = [1 / (rank + 1) for rank in range(distinct)]
+            ctx = fake_ctx(command='question')
+            started = time.perf_counter()
+            try:
+                for prompt in rng.choices(range(distinct), weights, k=total):
+                    history = [{"role": "user", "content": f"bench: question number {prompt}?"}]
+                    await bot.get_jyle_response(history, "bench", "1", ctx)
+            finally:
+                await bot.close()
+            cache = bot.response_cache
+            return (server.requests, cache.hits, cache.misses, cache.evictions, round(cache.hit_ratio, 4),
+                    len(cache.entries), cache.bytes, time.perf_counter() - started)
+
+        first = asyncio.run(run())
+        server.requests = 0
+        second = asyncio.run(run())
+        requests, hits, misses, evictions, ratio, entries, size, elapsed = first
+        print(f"  OpenAI calls {requests}/{total}   hit ratio {ratio:.1%}   {evictions} evictions   "
+              f"{entries} entries / {size / 1024:.1f} KiB   {elapsed:.2f}s")
+        print(f"  reproducible across runs: {first[:-1] == second[:-1]}")
+
+
+def bench_semantic_cache(sizes=(10_000, 100_000), lookups=500, dim=256):
+    """Semantic cache lookup time (one matrix-vector product) at different cache sizes"""
+    print(f"semantic_cache: {dim}-dim vectors, mean of {lookups} lookups")
+    rng = np.random.default_rng(5)
+    for size in sizes:
+        index = main.SemanticIndex(dim, size, ttl=3600)
+        vectors = rng.standard_normal((size, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        started = time.perf_counter()
+        for vector in vectors:
+            index.insert(vector, "cached answer")
+        fill = time.perf_counter() - started
+        queries = vectors[rng.integers(0, size, lookups)]
+        started = time.perf_counter()
+        hits = sum(index.lookup(query, 0.85) is not None for query in queries)
+        elapsed = (time.perf_counter() - started) / lookups
+        print(f"  {size:>7,} entries   lookup {elapsed * 1e6:8.1f} us   hits {hits}/{lookups}   "
+              f"insert {fill / size * 1e6:.1f} us/entry   matrix {index.matrix.nbytes / 2**20:.1f} MiB")
+
+    async def embedded():
+        cache = main.SemanticCache(HashingEmbedder(dim), threshold=0.85)
+        _, vector = await cache.get("guild", "what's a closure?")
+        cache.put("guild", vector, "cached answer")
+        started = time.perf_counter()
+        for _ in range(lookups):
+            await cache.get("guild", "can you explain closures")
+        return (time.perf_counter() - started) / lookups, cache.hit_ratio
+    elapsed, hit_ratio = asyncio.run(embedded())
+    print(f"  with HashingEmbedder: embed + lookup {elapsed * 1e6:.1f} us, rephrasing hit rate {hit_ratio:.0%}")
+
+
+def bench_history_trim(appends=(10_000, 100_000, 1_000_000), budgets=(300, 3000, 30_000)):
+    """Per-message cost of appending + token-budget trimming as channels grow"""
+    print("history_trim: append one message and trim to the budget, per-message cost")
+    rng = random.Random(9)
+    texts = [f"bench: {'word ' * rng.randint(1, 80)}" for _ in range(1000)]
+    for budget in budgets:
+        for count in appends:
+            history = main.ConversationHistory()
+            started = time.perf_counter()
+            for i in range(count):
+                history.append("user", texts[i % len(texts)])
+                history.trim(budget)
+            elapsed = time.perf_counter() - started
+            print(f"  budget {budget:>6} tokens  {count:>9,} messages   {elapsed / count * 1e9:7.0f} ns/message   "
+                  f"window {len(history)} messages / {history.tokens} tokens")
+
+
+def bench_summaries(turns=200, long_budget=6000, short_budget=1000, flush_every=10):
+    """Prompt tokens per request on a replayed transcript: long window vs. short window + rolling summary"""
+    print(f"summaries: {turns}-turn replayed transcript, summaries refreshed every {flush_every} turns")
+    rng = random.Random(13)
+    topics = ["closures", "recursion", "photosynthesis", "the French revolution", "binary search", "derivatives"]
+    transcript = [
+        f"student{rng.randint(1, 6)}: can you remind me how {rng.choice(topics)} works? " + "and also " * rng.randint(0, 30)
+        for _ in range(turns)
+    ]
+    reply = "Sure! " + "Here is a fairly detailed explanation sentence. " * 12
+
+    def responder(body):
+        if body.get("response_format", {}).get("type") == "json_object":
+            channels = json.loads(body["messages"][-1]["content"])
+            return json.dumps({channel_id: "Students asked about " + ", ".join(topics) + ". " + "Key facts noted. " * 8
+                               for channel_id in channels})
+        return reply
+
+    with FakeOpenAIServer(latency=0.0) as server:
+        server.responder = responder
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def replay(budget, summaries):
+            server.prompt_tokens.clear()
+            bot = main.AIDiscordBot()
+            bot.history_token_budget = budget
+            bot.summaries_enabled = summaries
+            history = bot.conversations.get_or_create("1")
+            evicted = 0
+            try:
+                for turn, line in enumerate(transcript, 1):
+                    history.append("user", line)
+                    before = len(history)
+                    bot.trim_history("1", history)
+                    evicted += before - len(history)
+                    answer = await bot.get_jyle_response(history.messages(), "student", "1", fake_ctx())
+                    history.append("assistant", answer)
+                    if summaries and turn % flush_every == 0:
+                        await bot.summarizer.flush()
+            finally:
+                await bot.close()
+            chat = [tokens for is_summary, tokens in server.prompt_tokens if not is_summary]
+            summary = [tokens for is_summary, tokens in server.prompt_tokens if is_summary]
+            remembered = len(history) + (evicted if history.summary else 0)
+            return sum(chat) / len(chat), sum(summary) / len(chat), len(summary), remembered
+
+        for label, budget, summaries in (
+            (f"window {long_budget} tokens", long_budget, False),
+            (f"window {short_budget} tokens", short_budget, False),
+            (f"window {short_budget} + summary", short_budget, True),
+        ):
+            chat, summary, calls, remembered = asyncio.run(replay(budget, summaries))
+            print(f"  {label:<28} {chat:7.0f} prompt tokens/request   +{summary:5.0f} summary tokens/request "
+                  f"({calls} batch calls)   {remembered} of {2 * turns} messages in context or summary")
+
+
+def bench_prompt_prefix(turns=40, users=6):
+    """How much of each prompt is a byte-identical prefix of an earlier one, old layout vs. new"""
+    print(f"prompt_prefix: one channel, {turns} turns from {users} students")
+    with FakeOpenAIServer(latency=0.0) as server:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def replay():
+            bot = main.AIDiscordBot()
+            bot.summaries_enabled = False
+            history = main.ConversationHistory()
+            old_layout = []
+            try:
+                for turn in range(turns):
+                    name = f"student{turn % users}"
+                    history.append("user", f"{name}: question {turn} about homework")
+                    bot.trim_history("1", history)
+                    # What the prompt looked like with the user's name spliced into the first message
+                    old_layout.append(json.dumps(
+                        [{"role": "system", "content": bot.personalities[False] + f" The user you're talking to is {name}."}]
+                        + history.messages()
+                    ))
+                    answer = await bot.get_jyle_response(history.messages(), name, "1", fake_ctx(user_id=turn % users, name=name))
+                    history.append("assistant", answer)
+            finally:
+                await bot.close()
+            return bot, old_layout
+
+        bot, old_layout = asyncio.run(replay())
+        old_shared = sum(len(os.path.commonprefix([a, b])) / len(b) for a, b in zip(old_layout, old_layout[1:]))
+        route = next(route for route in bot.router.routes if route.requests)
+        print(f"  {'name in first message':<28} {old_shared / (turns - 1):6.1%} of each prompt shared with the previous one")
+        print(f"  {'stable prefix, name last':<28} {route.cached_tokens / route.prompt_tokens:6.1%} of prompt tokens cached   "
+              f"prefix stability {bot.prefix_tracker.stability:.0%}")
+
+
+def bench_banter_pool(requests=40, latency=0.6, gap=0.05):
+    """!banter latency: generating every line on demand vs. popping from the pre-generated pool"""
+    print(f"banter_pool: {requests} !banter commands {gap * 1000:.0f} ms apart, {latency * 1000:.0f} ms per completion")
+
+    def responder(body):
+        if body.get("response_format", {}).get("type") == "json_object":
+            count = int(body["messages"][-1]["content"].split()[1])
+            return json.dumps({"banter": [f"Pre-baked sass #{i} 💅" for i in range(count)]})
+        return "Fresh sass, made to order 💅"
+
+    with FakeOpenAIServer(latency=latency) as server:
+        server.responder = responder
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def run(pooled):
+            bot = main.AIDiscordBot()
+            command = bot.bot.get_command('banter')
+            latencies = []
+            if pooled:
+                bot.banter_pool.refill_interval = 0.1
+                bot.banter_pool.start()
+                await asyncio.sleep(latency * 2)  # the bot sits idle for a moment after startup
+            else:
+                bot.banter_pool.size = 0
+            try:
+                for i in range(requests):
+                    ctx = fake_ctx(channel_id=i % 3, command='banter')
+                    started = time.perf_counter()
+                    await command.callback(ctx)
+                    latencies.append(time.perf_counter() - started)
+                    await asyncio.sleep(gap)
+            finally:
+                await bot.close()
+            return latencies, bot.banter_pool
+
+        for label, pooled in (("generated on demand", False), ("pre-generated pool", True)):
+            latencies, pool = asyncio.run(run(pooled))
+            print(f"  {label:<28} p50 {percentile(latencies, 50) * 1000:7.1f} ms   p99 {percentile(latencies, 99) * 1000:7.1f} ms   "
+                  f"pool hit rate {pool.hit_rate:.0%}")
+
+
+def bench_backends(total=400, concurrency=16, openai_latency=0.25, local_latency=0.05, local_slots=4):
+    """Throughput and latency across an OpenAI backend and a local OpenAI-compatible stub, per selection strategy"""
+    print(f"backends: {total} completions, {concurrency} concurrent, openai {openai_latency * 1000:.0f} ms, "
+          f"local {local_latency * 1000:.0f} ms with {local_slots} slots")
+    with FakeOpenAIServer(latency=openai_latency) as remote, FakeOpenAIServer(latency=local_latency) as local:
+        os.environ['OPENAI_BASE_URL'] = remote.base_url
+
+        async def run(specs, strategy, outage=False):
+            bot = main.AIDiscordBot()
+            bot.backends = main.BackendPool([bot.make_backend(spec) for spec in specs], strategy=strategy)
+            bot.admission.limit = concurrency
+            ctx = fake_ctx()
+            if outage:
+                local.fail_next, local.fail_status = total, 500
+
+            async def call(i):
+                await bot.get_jyle_response([{"role": "user", "content": f"bench: explain closures #{i}"}], "bench", "1", ctx)
+            try:
+                elapsed, latencies = await drive(call, total, concurrency)
+            finally:
+                local.fail_next = 0
+                await bot.close()
+            return elapsed, latencies, {backend.name: backend.requests for backend in bot.backends}
+
+        budget = (100_000, 10_000_000)  # rpm, tpm - high enough that key budgets never limit this bench
+        openai_only = [{"name": "openai", "base_url": remote.base_url, "api_keys": [("sk-bench", *budget)], "max_concurrency": 32}]
+        both = openai_only + [{"name": "local", "base_url": local.base_url, "api_keys": [("local", *budget)], "model": "llama-3-8b-instruct",
+                               "max_concurrency": local_slots, "weight": 1.0}]
+        for label, specs, strategy, outage in (
+            ("openai only", openai_only, "weighted", False),
+            ("openai + local, weighted", both, "weighted", False),
+            ("openai + local, latency", both, "latency", False),
+            ("latency, local failing", both, "latency", True),
+        ):
+            elapsed, latencies, served = asyncio.run(run(specs, strategy, outage))
+            report(label, elapsed, latencies)
+            print(f"  {'':<28} served by " + ", ".join(f"{name} {count}" for name, count in served.items()))
+
+
+def bench_key_pool(total=400, rate=60, limits=(40, 20, 10)):
+    """Requests spread over several API keys by headroom vs. one key, with per-key request limits per second"""
+    keys = [f"sk-bench-key{number}" for number in range(len(limits))]
+    print(f"key_pool: {total} requests at {rate}/s, keys allow {', '.join(map(str, limits))} requests/s")
+    logging.getLogger("main").setLevel(logging.CRITICAL)  # every shed request logs an error here
+    with FakeOpenAIServer(latency=0.05) as server:
+        server.key_limits = dict(zip(keys, limits))
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def run(api_keys, revoked=()):
+            server.key_log.clear()
+            server.throttled = 0
+            server.revoked_keys = set(revoked)
+            bot = main.AIDiscordBot()
+            spec = {"name": "openai", "base_url": server.base_url, "api_keys": api_keys, "max_concurrency": 64}
+            bot.backends = main.BackendPool([bot.make_backend(spec)])
+            for key in bot.backends.backends["openai"].keys:
+                key.window = server.key_window
+            bot.admission.limit = 64
+            latencies = []
+
+            async def call(i):
+                await asyncio.sleep(i / rate)
+                started = time.perf_counter()
+                await bot.get_jyle_response([{"role": "user", "content": f"bench: explain closures #{i}"}], "bench", "1", fake_ctx())
+                latencies.append(time.perf_counter() - started)
+            try:
+                await asyncio.gather(*(call(i) for i in range(total)))
+            finally:
+                await bot.close()
+            return latencies, bot.backends.backends["openai"].keys, bot.retry_policy.failed
+
+        budgets = [(key, limit, 1_000_000) for key, limit in zip(keys, limits)]
+        for label, api_keys, revoked in (
+            ("one key", budgets[:1], ()),
+            ("key pool by headroom", budgets, ()),
+            ("key pool, one key revoked", budgets, keys[:1]),
+        ):
+            latencies, pool, failed = asyncio.run(run(api_keys, revoked))
+            print(f"  {label:<28} p50 {percentile(latencies, 50) * 1000:7.1f} ms   p99 {percentile(latencies, 99) * 1000:7.1f} ms   "
+                  f"{server.throttled} 429s   {failed} gave up")
+            print(f"  {'':<28} " + ", ".join(
+                f"{key.label.split()[0]} {key.requests} reqs" + (f" ({key.quarantine_reason})" if key.quarantine_reason else "")
+                for key in pool
+            ))
+
+
+def bench_partial_responses(runs=3, tokens=100, token_delay=0.04, deadline=1.5):
+    """A reply that outlives its command deadline: deadline message vs. the partial text, and tokens paid for"""
+    reply = " ".join(f"word{i}" for i in range(tokens))
+    print(f"partial_responses: {tokens}-token reply at {token_delay * 1000:.0f} ms/token, {deadline:.1f}s !jyle deadline")
+    with FakeOpenAIServer(latency=0.1, reply=reply, token_delay=token_delay) as server:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def run(partial):
+            server.streamed_tokens = 0
+            bot = main.AIDiscordBot()
+            bot.partial_responses = partial
+            bot.command_deadlines['jyle'] = deadline
+            elapsed, delivered = [], []
+            try:
+                for i in range(runs):
+                    ctx = fake_ctx(channel_id=i, command='jyle')
+                    started = time.perf_counter()
+                    text = await bot.get_jyle_response([{"role": "user", "content": f"bench: tell me a long story #{i}"}], "bench", str(i), ctx)
+                    elapsed.append(time.perf_counter() - started)
+                    delivered.append(len(text.split()) if text.endswith(bot.cut_short_marker) else 0)
+                await asyncio.sleep(tokens * token_delay)  # let anything still generating run to the end
+            finally:
+                await bot.close()
+            return elapsed, delivered, server.streamed_tokens / runs
+
+        for label, partial in (("deadline message", False), ("partial + cancel", True)):
+            elapsed, delivered, generated = asyncio.run(run(partial))
+            print(f"  {label:<28} reply after {percentile(elapsed, 50):5.2f}s   {sum(delivered) / runs:5.0f} words shown   "
+                  f"{generated:5.0f} tokens generated per request")
+
+
+def bench_cancellation(channels=10, deleted=5, tokens=100, token_delay=0.04, after=1.0):
+    """Tokens generated and replies posted when trigger messages are deleted or !clear runs mid-generation"""
+    reply = " ".join(f"word{i}" for i in range(tokens))
+    print(f"cancellation: !jyle in {channels} channels, {tokens}-token replies at {token_delay * 1000:.0f} ms/token; "
+          f"after {after:.0f}s {deleted} trigger messages are deleted and one channel runs !clear")
+    with FakeOpenAIServer(latency=0.1, reply=reply, token_delay=token_delay) as server:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+        async def run(cancel):
+            server.streamed_tokens = 0
+            bot = main.AIDiscordBot()
+            jyle, clear = bot.bot.get_command('jyle'), bot.bot.get_command('clear')
+            contexts = [fake_ctx(channel_id=channel, command='jyle') for channel in range(channels)]
+            try:
+                tasks = [asyncio.create_task(jyle.callback(ctx, message=f"bench: tell me a long story #{i}"))
+                         for i, ctx in enumerate(contexts)]
+                await asyncio.sleep(after)
+                if cancel:
+                    for ctx in contexts[:deleted]:
+                        await bot.bot.on_raw_message_delete(SimpleNamespace(message_id=ctx.message.id))
+                    await clear.callback(fake_ctx(channel_id=deleted, command='clear'))
+                await asyncio.sleep(0.1)
+                held = bot.admission.active
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await asyncio.sleep(tokens * token_delay)  # let anything still generating run to the end
+                posted = sum(any(not message.deleted for _, message in ctx.sent) for ctx in contexts[:deleted + 1])
+                polluted = sum(len(bot.conversations.get(str(channel), ())) for channel in range(deleted))
+                return server.streamed_tokens, posted, polluted, held
+            finally:
+                await bot.close()
+
+        for label, cancel in (("deletes ignored", False), ("tracked + cancelled", True)):
+            generated, posted, polluted, active = asyncio.run(run(cancel))
+            print(f"  {label:<28} {generated:5d} tokens generated   {posted} of {deleted + 1} replies posted   "
+                  f"{polluted} turns left in deleted-message histories   {active} slots held just after")
+
+
+def bench_conversation_store(channels=50_000, turns=6, max_bytes=16 * 1024 * 1024):
+    """Resident memory after many channels chat once: unbounded dict vs. budgeted ConversationStore"""
+    print(f"conversation_store: {channels} channels x {turns} messages, store budget {max_bytes / 1024 / 1024:.0f} MB")
+    line = "student: can you explain how recursion works with an example please? " * 2
+
+    def fill(conversations, get_or_create):
+        tracemalloc.start()
+        started = time.perf_counter()
+        for channel in range(channels):
+            history = get_or_create(conversations, str(channel))
+            for _ in range(turns):
+                history.append("user", f"{line}{channel}")
+        elapsed = time.perf_counter() - started
+        resident = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return elapsed, resident
+
+    def dict_get_or_create(conversations, key):
+        if key not in conversations:
+            conversations[key] = main.ConversationHistory()
+        return conversations[key]
+
+    conversations = {}
+    elapsed, resident = fill(conversations, dict_get_or_create)
+    print(f"  {'plain dict':<28} {resident / 1024 / 1024:7.1f} MB resident   {len(conversations)} histories   "
+          f"{elapsed / (channels * turns) * 1e6:5.2f} us/message")
+    del conversations
+
+    store = main.ConversationStore(max_entries=channels, max_bytes=max_bytes)
+    elapsed, resident = fill(store, lambda store, key: store.get_or_create(key))
+    store.sweep()
+    print(f"  {'ConversationStore':<28} {resident / 1024 / 1024:7.1f} MB resident   {len(store)} histories   "
+          f"{elapsed / (channels * turns) * 1e6:5.2f} us/message   accounted {store.bytes / 1024 / 1024:.1f} MB, "
+          f"{store.evictions} evicted")
+
+
+def bench_history_memory(channels=100_000, turns=10):
+    """Resident memory of many channel histories: lists of message dicts vs. compact ring buffers"""
+    print(f"history_memory: {channels:,} channels x {turns} messages")
+    rng = random.Random(5)
+    texts = [f"student{i % 30}: {'some words ' * rng.randint(1, 12)}" for i in range(997)]
+
+    def measure(build):
+        tracemalloc.start()
+        started = time.perf_counter()
+        conversations = build()
+        elapsed = time.perf_counter() - started
+        resident = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return conversations, elapsed, resident
+
+    def dict_lists():
+        conversations = {}
+        for channel in range(channels):
+            history = conversations[str(channel)] = []
+            for turn in range(turns):
+                # Contents are copied so every message owns its string, like real chat text
+                history.append({"role": "user" if turn % 2 == 0 else "assistant",
+                                "content": texts[(channel + turn) % len(texts)][:-1] + " "})
+        return conversations
+
+    def ring_buffers():
+        conversations = {}
+        for channel in range(channels):
+            history = conversations[str(channel)] = main.ConversationHistory()
+            for turn in range(turns):
+                history.append("user" if turn % 2 == 0 else "assistant", texts[(channel + turn) % len(texts)][:-1] + " ")
+        return conversations
+
+    for label, build in (("lists of message dicts", dict_lists), ("compact ring buffers", ring_buffers)):
+        conversations, elapsed, resident = measure(build)
+        accounted = ""
+        if label.startswith("compact"):
+            accounted = f"   nbytes estimate {sum(history.nbytes for history in conversations.values()) / 1024 / 1024:6.1f} MB"
+        print(f"  {label:<28} {resident / 1024 / 1024:7.1f} MB resident   {resident / channels:6.0f} B/channel   "
+              f"built in {elapsed:.2f}s{accounted}")
+        del conversations
+
+
+def bench_append_trim(count=200_000, windows=(10, 200), budget=3000):
+    """Per-message cost of the history append/trim path: list + [-N:] slice vs. ring buffer"""
+    print(f"append_trim: {count:,} appends to one channel (a {budget}-token budget holds ~57 of these messages)")
+    rng = random.Random(9)
+    texts = [f"student: {'word ' * rng.randint(1, 80)}" for _ in range(1000)]
+
+    def list_path(window):
+        conversations = {"1": []}
+        for i in range(count):
+            conversations["1"].append({"role": "user", "content": texts[i % len(texts)]})
+            if len(conversations["1"]) > window:
+                conversations["1"] = conversations["1"][-window:]
+
+    def ring_path(max_turns, budget):
+        history = main.ConversationHistory(max_turns=max_turns)
+        for i in range(count):
+            history.append("user", texts[i % len(texts)])
+            history.trim(budget)
+
+    for label, path in (
+        (f"list, keep last {windows[0]}", lambda: list_path(windows[0])),
+        (f"ring, max {windows[0]} turns", lambda: ring_path(windows[0], 1 << 30)),
+        (f"list, keep last {windows[1]}", lambda: list_path(windows[1])),
+        (f"ring, {budget}-token budget", lambda: ring_path(200, budget)),
+    ):
+        started = time.perf_counter()
+        path()
+        elapsed = time.perf_counter() - started
+        print(f"  {label:<28} {elapsed / count * 1e9:7.0f} ns/message")
+
+
+def bench_durable_store(appends=100_000, channels=500, cold_channels=10_000, cold_turns=50, loads=2000):
+    """SQLite persistence: per-append commits on the event loop vs. the write-behind DurableStore,
+    plus cold-load latency of channel histories"""
+    print(f"durable_store: {appends:,} appends over {channels} channels, cold loads from {cold_channels:,} channels x {cold_turns} turns")
+    rng = random.Random(11)
+    texts = [f"student{i % 30}: {'some words ' * rng.randint(1, 20)}" for i in range(997)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Baseline: commit every append inline, like a naive synchronous store would
+        store = main.DurableStore(os.path.join(tmp, "sync.db"))
+        db = store.connect()
+        blocked = []
+        started = time.perf_counter()
+        for i in range(appends):
+            begin = time.perf_counter()
+            db.execute("INSERT OR REPLACE INTO turns VALUES (?, ?, ?, ?)", (str(i % channels), i // channels + 1, "user", texts[i % len(texts)]))
+            blocked.append(time.perf_counter() - begin)
+        elapsed = time.perf_counter() - started
+        db.close()
+        print(f"  {'commit per append':<28} {appends / elapsed:9,.0f} appends/s   loop blocked p50 {percentile(blocked, 50) * 1e6:6.1f} us  "
+              f"p99 {percentile(blocked, 99) * 1e6:7.1f} us  max {max(blocked) * 1e3:6.2f} ms")
+
+        async def write_behind():
+            store = main.DurableStore(os.path.join(tmp, "write_behind.db"))
+            store.start()
+            lags = []
+            stop = asyncio.Event()
+
+            async def ticker():
+                while not stop.is_set():
+                    begin = time.perf_counter()
+                    await asyncio.sleep(0.001)
+                    lags.append(time.perf_counter() - begin - 0.001)
+
+            tick = asyncio.create_task(ticker())
+            blocked = []
+            started = time.perf_counter()
+            for i in range(appends):
+                begin = time.perf_counter()
+                store.append(str(i % channels), i // channels + 1, "user", texts[i % len(texts)])
+                blocked.append(time.perf_counter() - begin)
+                if i % 1000 == 999:
+                    await asyncio.sleep(0)  # let the ticker and other commands run, like a busy bot
+            enqueued = time.perf_counter() - started
+            await store.close()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await tick
+            print(f"  {'write-behind queue':<28} {appends / elapsed:9,.0f} appends/s   loop blocked p50 {percentile(blocked, 50) * 1e6:6.1f} us  "
+                  f"p99 {percentile(blocked, 99) * 1e6:7.1f} us  max {max(blocked) * 1e3:6.2f} ms")
+            print(f"  {'':<28} enqueued in {enqueued:.2f}s, drained by {elapsed:.2f}s in {store.batches} transactions "
+                  f"({store.writes / max(store.batches, 1):.0f} appends each), ticker lag p99 {percentile(lags, 99) * 1e3:.2f} ms")
+
+        asyncio.run(write_behind())
+
+        # Cold loads: a big database, a fresh process, channels read back on first use
+        path = os.path.join(tmp, "cold.db")
+        store = main.DurableStore(path)
+        db = store.connect()
+        db.execute("BEGIN")
+        db.executemany("INSERT INTO turns VALUES (?, ?, ?, ?)", (
+            (str(channel), seq, "user" if seq % 2 else "assistant", texts[(channel + seq) % len(texts)])
+            for channel in range(cold_channels) for seq in range(1, cold_turns + 1)
+        ))
+        db.executemany("INSERT INTO channels VALUES (?, ?, ?)",
+                       ((str(channel), None, "they talked about recursion") for channel in range(0, cold_channels, 3)))
+        db.execute("COMMIT")
+        db.close()
+        print(f"  cold database {os.path.getsize(path) / 1024 / 1024:.0f} MB")
+
+        async def cold_loads():
+            store = main.DurableStore(path)
+            store.start()
+            picks = [str(rng.randrange(cold_channels)) for _ in range(loads)]
+            latencies = []
+            for channel in picks:
+                begin = time.perf_counter()
+                _, _, turns = await store.load(channel)
+                latencies.append(time.perf_counter() - begin)
+            assert len(turns) == cold_turns
+            print(f"  {'cold load, one at a time':<28} p50 {percentile(latencies, 50) * 1e3:6.2f} ms   p99 {percentile(latencies, 99) * 1e3:6.2f} ms")
+
+            async def timed(channel):
+                begin = time.perf_counter()
+                await store.load(channel)
+                return time.perf_counter() - begin
+
+            latencies = await asyncio.gather(*(timed(str(rng.randrange(cold_channels))) for _ in range(loads)))
+            print(f"  {f'cold load, {loads} at once':<28} p50 {percentile(latencies, 50) * 1e3:6.2f} ms   p99 {percentile(latencies, 99) * 1e3:6.2f} ms")
+            await store.close()
+
+        asyncio.run(cold_loads())
+
+
+def bench_snapshot(channels=50_000, turns=10):
+    """Warm restart: snapshot and restore of the whole in-memory state of a 50k-channel bot"""
+    print(f"snapshot: {channels:,} channels x {turns} messages, plus nicknames and roast mode")
+    rng = random.Random(13)
+    texts = [f"student{i % 30}: {'some words ' * rng.randint(1, 12)}" for i in range(997)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['JYLE_SNAPSHOT_PATH'] = os.path.join(tmp, "state.snap")
+        try:
+            bot = main.AIDiscordBot()
+        finally:
+            del os.environ['JYLE_SNAPSHOT_PATH']
+        bot.conversations.max_entries = bot.conversations.max_bytes = 1 << 40
+        for channel in range(channels):
+            history = main.ConversationHistory(persona="You are Jyle, a pirate." if channel % 50 == 0 else None)
+            for turn in range(turns):
+                history.append("user" if turn % 2 == 0 else "assistant", texts[(channel + turn) % len(texts)][:-1] + " ")
+            if channel % 5 == 0:
+                history.set_summary("they talked about recursion and pizza")
+            bot.conversations[str(channel)] = history
+            if channel % 10 == 0:
+                bot.user_nicknames[str(channel)] = f"nick{channel}"
+                bot.roast_mode[str(channel)] = True
+
+        async def save():
+            await bot.snapshots.save()
+        asyncio.run(save())
+        print(f"  {'snapshot':<28} {bot.snapshots.last_save_time * 1000:6.0f} ms total   "
+              f"{bot.snapshots.last_collect_time * 1000:6.0f} ms on the event loop   {bot.snapshots.last_size / 1024 / 1024:.1f} MB file")
+
+        restored = main.AIDiscordBot()
+        restored.snapshot_path = bot.snapshot_path
+        restored.snapshots = main.StateSnapshot(bot.snapshot_path, restored.collect_state)
+        restored.conversations.max_entries = restored.conversations.max_bytes = 1 << 40
+        started = time.perf_counter()
+        restored.restore_state()
+        elapsed = time.perf_counter() - started
+        same = all(a.messages() == b.messages() for (_, a, _), (_, b, _) in zip(bot.conversations.items(), restored.conversations.items()))
+        print(f"  {'restore':<28} {elapsed * 1000:6.0f} ms   {len(restored.conversations):,} conversations, "
+              f"{len(restored.user_nicknames):,} nicknames, {len(restored.roast_mode):,} roast channels, identical: {same}")
+
+
+def bench_conversation_scope(students=30, requests=300, seed=17):
+    """Prompt tokens per request in a busy class channel: one shared history vs. one per (channel, user)"""
+    print(f"conversation_scope: {students} students taking turns in one channel, {requests:,} requests")
+    rng = random.Random(seed)
+    askers = [rng.randrange(students) for _ in range(requests)]
+    questions = [f"{'how does this part work ' * rng.randint(3, 8)}" for _ in range(101)]
+    answers = [f"{'well it works like this ' * rng.randint(10, 30)}" for _ in range(101)]
+
+    for scope in ("channel", "user"):
+        os.environ['JYLE_CONVERSATION_SCOPE'] = scope
+        try:
+            bot = main.AIDiscordBot()
+        finally:
+            del os.environ['JYLE_CONVERSATION_SCOPE']
+        budget = bot.history_budget()
+        prompt_tokens, own_share = [], []
+        for i, student in enumerate(askers):
+            ctx = fake_ctx(user_id=student, channel_id=1, name=f"student{student}")
+            history = bot.conversations.get_or_create(bot.conversation_key(ctx))
+            history.append("user", f"student{student}: {questions[i % len(questions)]}")
+            history.trim(budget)
+            turns = list(history)
+            prompt_tokens.append(history.persona_tokens + history.summary_tokens + history.tokens)
+            # The asker's own questions and the answers to them, as a share of the prompt
+            own = sum(turn[2] for turn, asked_by in zip(turns, askers_of(turns)) if asked_by == f"student{student}")
+            own_share.append(own / history.tokens)
+            history.append("assistant", f"{ctx.author.display_name}, {answers[i % len(answers)]}")
+        print(f"  {scope + ' scope':<28} {sum(prompt_tokens) / requests:7.0f} prompt tokens/request (p50 {percentile(prompt_tokens, 50):5.0f})   "
+              f"{sum(own_share) / requests:6.1%} of it about the asker   {len(bot.conversations)} histories, "
+              f"{bot.conversations.bytes / 1024:.0f} KB")
+
+
+def askers_of(turns):
+    """Who each turn belongs to: a user turn's author, or for a reply the author it addresses"""
+    return [content.split(":" if role == "user" else ",", 1)[0] for role, content, _ in turns]
+
+
+BENCHMARKS = {
+    'async_client': bench_async_client,
+    'streaming': bench_streaming,
+    'fair_queue': bench_fair_queue,
+    'hedging': bench_hedging,
+    'response_cache': bench_response_cache,
+    'semantic_cache': bench_semantic_cache,
+    'history_trim': bench_history_trim,
+    'summaries': bench_summaries,
+    'prompt_prefix': bench_prompt_prefix,
+    'banter_pool': bench_banter_pool,
+    'backends': bench_backends,
+    'key_pool': bench_key_pool,
+    'partial_responses': bench_partial_responses,
+    'cancellation': bench_cancellation,
+    'conversation_store': bench_conversation_store,
+    'history_memory': bench_history_memory,
+    'append_trim': bench_append_trim,
+    'durable_store': bench_durable_store,
+    'snapshot': bench_snapshot,
+    'conversation_scope': bench_conversation_scope,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
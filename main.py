@@ -3,19 +3,1785 @@ load_dotenv()
 import discord
 from discord.ext import commands
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI
+import httpx
+import numpy as np
 import asyncio
 import os
+import sys
 from typing import Optional
 import json
 import logging
 from datetime import datetime
 import random
+import time
+import math
+import re
+import gc
+import hashlib
+import marshal
+import sqlite3
+import threading
+import queue
+from collections import deque, Counter, OrderedDict
+from email.utils import parsedate_to_datetime
+from contextlib import asynccontextmanager, contextmanager
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class StreamingReply:
+    """Shows a completion in Discord while it streams in, using throttled message edits"""
+    def __init__(self, ctx, edit_interval=1.0, edit_chars=40, limit=2000, embed_factory=None):
+        self.ctx = ctx
+        self.edit_interval = edit_interval  # minimum seconds between edits (Discord rate limits)
+        self.edit_chars = edit_chars  # minimum new characters worth an edit
+        self.limit = limit
+        self.embed_factory = embed_factory  # builds an embed from text, for embed replies
+        self.messages = []
+        self.rendered = []
+        self.text = ""
+        self.started = time.monotonic()
+        self.last_edit = 0.0
+        self.first_visible = None
+
+    async def update(self, text: str):
+        """Called with the accumulated text every time new tokens arrive"""
+        self.text = text
+        if not text.strip():
+            return
+        if self.messages:
+            if time.monotonic() - self.last_edit < self.edit_interval:
+                return
+            if len(text) - sum(len(chunk) for chunk in self.rendered) < self.edit_chars:
+                return
+        try:
+            await self.flush()
+        except discord.HTTPException as e:
+            logger.warning(f"Streaming edit failed, will retry on the next update: {e}")
+
+    async def finish(self, text: str):
+        """Show the final text, sending it normally if nothing has been streamed yet"""
+        self.text = text
+        await self.flush()
+
+    async def flush(self):
+        """Bring the Discord messages in line with the current text, rolling over at the length limit"""
+        chunks = [self.text[i:i + self.limit] for i in range(0, len(self.text), self.limit)] or [self.text]
+        for index, chunk in enumerate(chunks):
+            if index < len(self.messages):
+                if self.rendered[index] != chunk:
+                    await self.messages[index].edit(**self.render(chunk))
+                    self.rendered[index] = chunk
+            else:
+                self.messages.append(await self.ctx.send(**self.render(chunk)))
+                self.rendered.append(chunk)
+        self.last_edit = time.monotonic()
+        if self.first_visible is None:
+            self.first_visible = self.last_edit - self.started
+            logger.info(f"First visible text after {self.first_visible * 1000:.0f} ms")
+
+    async def discard(self):
+        """Delete whatever has been streamed so far, for replies that were cancelled"""
+        for message in self.messages:
+            try:
+                await message.delete()
+            except discord.HTTPException as e:
+                logger.warning(f"Could not delete a cancelled reply: {e}")
+        self.messages = []
+        self.rendered = []
+
+    def render(self, chunk: str) -> dict:
+        if self.embed_factory:
+            return {"embed": self.embed_factory(chunk)}
+        return {"content": chunk}
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for a chat message: ~4 bytes per token plus per-message overhead"""
+    return len(text.encode()) // 4 + 4
+
+ROLES = {role: sys.intern(role) for role in ("system", "user", "assistant")}
+
+class ConversationHistory:
+    """One channel's chat history, trimmed to a token budget instead of a message count
+    
+    Turns are compact (role, content, tokens) tuples sharing the interned role strings,
+    kept in a ring buffer that grows on demand up to max_turns; past that, appending
+    pushes the oldest turn out. Token counts are computed once per turn with a running
+    total, so trimming only ever advances the old end. OpenAI message dicts are built by
+    messages() at request time. Trimmed turns wait in `evicted` until the summarizer
+    folds them into the running summary.
+    """
+    __slots__ = ("persona", "persona_tokens", "summary", "summary_text", "summary_tokens", "ring", "start",
+                 "count", "max_turns", "tokens", "overflow", "evicted", "nbytes", "seq")
+    SUMMARY_PREFIX = "Summary of the earlier conversation in this channel:"
+    BASE_BYTES = 240  # the object and its ring list
+    TURN_BYTES = 160  # the turn tuple, its token int, the content string header and a ring slot
+
+    def __init__(self, persona: str = None, max_turns=200):
+        self.persona = persona  # pinned system message, never trimmed
+        self.persona_tokens = estimate_tokens(persona) if persona else 0
+        self.summary = None  # content of the summary system message
+        self.summary_text = ""
+        self.summary_tokens = 0
+        self.ring = []
+        self.start = 0  # ring index of the oldest turn
+        self.count = 0
+        self.max_turns = max_turns
+        self.tokens = 0
+        self.overflow = []  # turns pushed out by a full ring, handed out by the next trim()
+        self.evicted = []
+        self.nbytes = self.BASE_BYTES + (self.turn_bytes(persona) if persona else 0)  # rough resident size
+        self.seq = 0  # number of the newest turn, counting every turn ever appended
+
+    @classmethod
+    def turn_bytes(cls, content: str) -> int:
+        return cls.TURN_BYTES + len(content)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Turns from oldest to newest"""
+        size = len(self.ring)
+        for offset in range(self.count):
+            yield self.ring[(self.start + offset) % size]
+
+    def append(self, role: str, content: str) -> tuple:
+        turn = (ROLES.get(role) or sys.intern(role), content, estimate_tokens(content))
+        size = len(self.ring)
+        if self.count == self.max_turns:
+            self.overflow.append(self.pop_oldest())
+        elif self.count == size:
+            if self.start:
+                # Unroll the ring so the new slot lands right after the newest turn
+                self.ring = self.ring[self.start:] + self.ring[:self.start]
+                self.start = 0
+            self.ring.append(None)
+            size += 1
+        self.ring[(self.start + self.count) % size] = turn
+        self.count += 1
+        self.seq += 1
+        self.tokens += turn[2]
+        self.nbytes += self.TURN_BYTES + len(content)
+        return turn
+
+    def pop_oldest(self) -> tuple:
+        turn = self.ring[self.start]
+        self.ring[self.start] = None
+        self.start = (self.start + 1) % len(self.ring)
+        self.count -= 1
+        self.tokens -= turn[2]
+        self.nbytes -= self.TURN_BYTES + len(turn[1])
+        return turn
+
+    def remove(self, turn: tuple) -> bool:
+        """Take a turn back out, e.g. when the Discord message that triggered it was deleted"""
+        size = len(self.ring)
+        for offset in range(self.count - 1, -1, -1):
+            if self.ring[(self.start + offset) % size] is turn:
+                # Close the gap by shifting the newer turns down one slot
+                for later in range(offset, self.count - 1):
+                    self.ring[(self.start + later) % size] = self.ring[(self.start + later + 1) % size]
+                self.ring[(self.start + self.count - 1) % size] = None
+                self.count -= 1
+                self.tokens -= turn[2]
+                self.nbytes -= self.turn_bytes(turn[1])
+                return True
+        return False
+
+    def trim(self, budget: int) -> list:
+        """Drop the oldest turns until the history fits the budget; the newest turn is always kept"""
+        dropped, self.overflow = self.overflow, []
+        budget -= self.persona_tokens + self.summary_tokens
+        while self.count > 1 and self.tokens > budget:
+            dropped.append(self.pop_oldest())
+        return dropped
+
+    def set_summary(self, text: str):
+        if self.summary:
+            self.nbytes -= self.turn_bytes(self.summary)
+        self.summary_text = text
+        self.summary = f"{self.SUMMARY_PREFIX} {text}"
+        self.nbytes += self.turn_bytes(self.summary)
+        self.summary_tokens = estimate_tokens(self.summary)
+
+    def dump(self) -> tuple:
+        """Plain-data copy of the history for snapshots (turns still waiting to be summarized are left out)"""
+        end = self.start + self.count
+        if end <= len(self.ring):
+            turns = self.ring[self.start:end]
+        else:
+            turns = self.ring[self.start:] + self.ring[:end - len(self.ring)]
+        return self.persona, self.summary_text, self.seq, self.max_turns, self.tokens, self.nbytes, turns
+
+    @classmethod
+    def restore(cls, state: tuple) -> "ConversationHistory":
+        """Rebuild a dump(); the turn tuples are reused as they are, since marshal keeps the roles interned"""
+        persona, summary_text, seq, max_turns, tokens, nbytes, turns = state
+        history = cls(persona=persona, max_turns=max_turns)
+        if summary_text:
+            history.set_summary(summary_text)
+        history.ring = list(turns)
+        history.count = len(turns)
+        history.tokens = tokens
+        history.nbytes = nbytes
+        history.seq = seq
+        return history
+
+    def messages(self) -> list:
+        """The history in OpenAI message format"""
+        pinned = [{"role": "system", "content": content} for content in (self.persona, self.summary) if content]
+        return pinned + [{"role": role, "content": content} for role, content, _ in self]
+
+class GenerationTracker:
+    """In-flight generations by channel and by the id of the message that triggered them
+    
+    A tracked generation is the command's task. Cancelling it unwinds the whole request:
+    the OpenAI stream is closed, admission and backend slots are released, and nothing
+    is posted or added to the history.
+    """
+    def __init__(self):
+        self.tasks = {}  # source message id -> (channel id, task)
+        self.by_channel = {}  # channel id -> set of source message ids
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.tasks)
+
+    @contextmanager
+    def track(self, channel_id: str, message_id: int):
+        """Register the current task as the generation for message_id while the block runs"""
+        self.tasks[message_id] = (channel_id, asyncio.current_task())
+        self.by_channel.setdefault(channel_id, set()).add(message_id)
+        try:
+            yield
+        finally:
+            self.tasks.pop(message_id, None)
+            ids = self.by_channel.get(channel_id)
+            if ids is not None:
+                ids.discard(message_id)
+                if not ids:
+                    del self.by_channel[channel_id]
+
+    def cancel_message(self, message_id: int) -> bool:
+        entry = self.tasks.get(message_id)
+        if entry is None or entry[1].done():
+            return False
+        entry[1].cancel()
+        self.cancelled += 1
+        return True
+
+    def cancel_channel(self, channel_id: str) -> int:
+        return sum(self.cancel_message(message_id) for message_id in list(self.by_channel.get(channel_id, ())))
+
+class ConversationStore:
+    """Conversation histories by key with idle-TTL expiry and LRU eviction under entry and byte budgets
+    
+    Sizes come from ConversationHistory.nbytes. A history is usually changed right after
+    it is fetched, so the sizes of the last few histories handed out are re-read on every
+    store operation, and all of them on every sweep. The background sweeper also expires
+    idle histories and re-applies the budgets.
+    """
+    def __init__(self, max_entries=20000, max_bytes=64 * 1024 * 1024, idle_ttl=7 * 24 * 3600, sweep_interval=60.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.entries = OrderedDict()  # key -> [history, last_access, size], least recently used first
+        self.recent = deque(maxlen=32)  # entries handed out lately, whose size may have changed since
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.task = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        self.refresh()
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        self.entries.move_to_end(key)
+        entry[1] = time.monotonic()
+        self.recent.append(entry)
+        self.enforce(keep=key)
+        return entry[0]
+
+    def get_or_create(self, key, factory=ConversationHistory):
+        history = self.get(key)
+        if history is None:
+            history = self[key] = factory()
+        return history
+
+    def __setitem__(self, key, history):
+        self.pop(key)
+        self.refresh()
+        entry = self.entries[key] = [history, time.monotonic(), history.nbytes]
+        self.bytes += history.nbytes
+        self.recent.append(entry)
+        self.enforce(keep=key)
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        history = entry[0]
+        self.bytes -= entry[2]
+        entry[0] = None  # so a copy left in self.recent is skipped
+        return history
+
+    def items(self) -> list:
+        """(key, history, idle seconds) for every history, least recently used first"""
+        now = time.monotonic()
+        return [(key, entry[0], now - entry[1]) for key, entry in self.entries.items()]
+
+    def load(self, items):
+        """Bulk-insert (key, history, idle seconds) items in least recently used order, as from items()"""
+        now = time.monotonic()
+        for key, history, idle in items:
+            self.pop(key)
+            self.entries[key] = [history, now - idle, history.nbytes]
+            self.bytes += history.nbytes
+        self.enforce()
+
+    def refresh(self):
+        for entry in self.recent:
+            self.resize(entry)
+
+    def resize(self, entry):
+        if entry[0] is None:
+            return
+        self.bytes += entry[0].nbytes - entry[2]
+        entry[2] = entry[0].nbytes
+
+    def enforce(self, keep=None):
+        """Evict least recently used histories until both budgets hold (never the one in use)"""
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            key = next(iter(self.entries))
+            if key == keep:
+                break
+            self.pop(key)
+            self.evictions += 1
+
+    def sweep(self):
+        """Expire idle histories, refresh sizes and re-apply the budgets"""
+        now = time.monotonic()
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry[1] < self.idle_ttl:
+                break
+            self.pop(key)
+            self.expirations += 1
+        for entry in self.entries.values():
+            self.resize(entry)
+        self.enforce()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+class DurableStore:
+    """Optional SQLite (WAL) copy of conversations, nicknames and roast mode that survives restarts
+    
+    Nothing on the event loop waits for the disk: changes go on a write-behind queue and
+    a background thread commits whatever has queued up in one transaction per batch.
+    Channel histories are read back lazily the first time a channel is used; reads go
+    through the same queue, so they see every change queued before them.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS turns (
+            channel TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL,
+            PRIMARY KEY (channel, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS channels (channel TEXT PRIMARY KEY, persona TEXT, summary TEXT);
+        CREATE TABLE IF NOT EXISTS settings (kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (kind, key));
+    """
+
+    def __init__(self, path: str, batch_size=1000, keep_turns=200, prune_every=50):
+        self.path = path
+        self.batch_size = batch_size
+        self.keep_turns = keep_turns  # turns kept on disk per channel
+        self.prune_every = prune_every
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.writes = 0
+        self.batches = 0
+        self.loads = 0
+        self.errors = 0
+
+    def connect(self):
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(self.SCHEMA)
+        return db
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="jyle-sqlite", daemon=True)
+            self.thread.start()
+
+    async def close(self):
+        """Commit everything still queued and stop the writer thread"""
+        if self.thread:
+            self.queue.put(None)
+            await asyncio.to_thread(self.thread.join)
+            self.thread = None
+
+    @property
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def append(self, channel: str, seq: int, role: str, content: str):
+        self.queue.put(("append", channel, seq, role, content))
+
+    def remove(self, channel: str, content: str):
+        self.queue.put(("remove", channel, content))
+
+    def clear(self, channel: str):
+        self.queue.put(("clear", channel))
+
+    def set_channel(self, channel: str, persona, summary):
+        self.queue.put(("channel", channel, persona, summary))
+
+    def set_setting(self, kind: str, key: str, value):
+        """Store a setting; a value of None deletes it"""
+        self.queue.put(("setting", kind, key, value))
+
+    async def load(self, channel: str):
+        """(persona, summary, [(seq, role, content)]) for a channel, oldest turn first"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put(("load", channel, loop, future))
+        return await future
+
+    def load_settings(self, kind: str) -> dict:
+        """Read every setting of one kind straight away; only meant for startup"""
+        db = self.connect()
+        try:
+            return dict(db.execute("SELECT key, value FROM settings WHERE kind = ?", (kind,)))
+        finally:
+            db.close()
+
+    def run(self):
+        db = self.connect()
+        try:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                self.commit(db, [item for item in batch if item is not None])
+                if stop:
+                    return
+        finally:
+            db.close()
+
+    def commit(self, db, batch: list):
+        """Apply a batch of queued changes in one transaction, answering the loads in it"""
+        answers = []
+        try:
+            db.execute("BEGIN")
+            for item in batch:
+                answer = self.apply(db, item)
+                if answer is not None:
+                    answers.append(answer)
+            db.execute("COMMIT")
+            self.batches += 1
+            self.writes += len(batch) - len(answers)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.error(f"SQLite write-behind batch of {len(batch)} failed: {e}")
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            answers = [(item[2], item[3], e) for item in batch if item[0] == "load"]
+        for loop, future, result in answers:
+            loop.call_soon_threadsafe(self.resolve, future, result)
+
+    @staticmethod
+    def resolve(future, result):
+        if future.done():
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def apply(self, db, item: tuple):
+        kind, channel = item[0], item[1]
+        if kind == "append":
+            _, _, seq, role, content = item
+            db.execute("INSERT OR REPLACE INTO turns VALUES (?, ?, ?, ?)", (channel, seq, role, content))
+            if seq % self.prune_every == 0:
+                db.execute("DELETE FROM turns WHERE channel = ? AND seq <= ?", (channel, seq - self.keep_turns))
+        elif kind == "remove":
+            db.execute(
+                "DELETE FROM turns WHERE channel = ? AND seq = (SELECT MAX(seq) FROM turns WHERE channel = ? AND content = ?)",
+                (channel, channel, item[2])
+            )
+        elif kind == "clear":
+            db.execute("DELETE FROM turns WHERE channel = ?", (channel,))
+            db.execute("DELETE FROM channels WHERE channel = ?", (channel,))
+        elif kind == "channel":
+            db.execute("INSERT OR REPLACE INTO channels VALUES (?, ?, ?)", (channel, item[2], item[3]))
+        elif kind == "setting":
+            _, setting, key, value = item
+            if value is None:
+                db.execute("DELETE FROM settings WHERE kind = ? AND key = ?", (setting, key))
+            else:
+                db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?, ?)", (setting, key, value))
+        elif kind == "load":
+            _, _, loop, future = item
+            self.loads += 1
+            row = db.execute("SELECT persona, summary FROM channels WHERE channel = ?", (channel,)).fetchone()
+            turns = db.execute(
+                "SELECT seq, role, content FROM turns WHERE channel = ? ORDER BY seq DESC LIMIT ?",
+                (channel, self.keep_turns)
+            ).fetchall()
+            turns.reverse()
+            return loop, future, (row[0] if row else None, row[1] if row else None, turns)
+        return None
+
+@contextmanager
+def paused_gc():
+    """Suspend the cyclic GC around bulk copies of long-lived state, which it would otherwise rescan over and over"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+class StateSnapshot:
+    """Periodic snapshot of the bot's in-memory state, for a warm restart after a redeploy
+    
+    The state is marshalled to a temporary file next to the snapshot, fsynced and renamed
+    over the previous snapshot, so a crash mid-write never leaves a torn file behind.
+    collect() runs on the event loop and must return plain data (dicts, lists, tuples,
+    strings and numbers) that nothing else mutates; encoding and writing happen in a thread.
+    """
+    MAGIC = b"JYLESNAP"
+    FORMAT = bytes([1, marshal.version])  # our layout version and marshal's
+
+    def __init__(self, path: str, collect, interval=60.0):
+        self.path = path
+        self.collect = collect
+        self.interval = interval
+        self.saves = 0
+        self.last_size = 0
+        self.last_save_time = 0.0
+        self.last_collect_time = 0.0  # the part spent on the event loop
+        self.task = None
+
+    def write(self, state) -> int:
+        data = self.MAGIC + self.FORMAT + marshal.dumps(state)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return len(data)
+
+    def read(self):
+        """The saved state, or None if there is no usable snapshot"""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        header = len(self.MAGIC) + len(self.FORMAT)
+        if data[:header] != self.MAGIC + self.FORMAT:
+            logger.warning(f"Ignoring snapshot {self.path}: unknown format")
+            return None
+        try:
+            return marshal.loads(data[header:])
+        except (EOFError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring corrupt snapshot {self.path}: {e}")
+            return None
+
+    async def save(self):
+        started = time.perf_counter()
+        with paused_gc():
+            state = self.collect()
+        self.last_collect_time = time.perf_counter() - started
+        self.last_size = await asyncio.to_thread(self.write, state)
+        self.last_save_time = time.perf_counter() - started
+        self.saves += 1
+        logger.info(f"Snapshot saved to {self.path}: {self.last_size / 1024 / 1024:.1f} MB in "
+                    f"{self.last_save_time * 1000:.0f} ms ({self.last_collect_time * 1000:.0f} ms on the event loop)")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Snapshot to {self.path} failed: {e}")
+
+class ConversationSummarizer:
+    """Background loop that folds evicted turns into running per-channel summaries
+    
+    Channels with newly evicted turns are marked dirty; every `interval` seconds the
+    dirty channels are handed to `summarize_batch` in groups of `batch_size`, so one
+    completion call refreshes several channels and nothing runs on the request path.
+    """
+    def __init__(self, summarize_batch, interval=15.0, batch_size=8):
+        self.summarize_batch = summarize_batch
+        self.interval = interval
+        self.batch_size = batch_size
+        self.dirty = {}  # channel_id -> ConversationHistory
+        self.task = None
+        self.batches = 0
+        self.failures = 0
+
+    def mark(self, channel_id: str, history: ConversationHistory):
+        self.dirty[channel_id] = history
+
+    def forget(self, channel_id: str):
+        """Drop a channel whose history was cleared or replaced"""
+        self.dirty.pop(channel_id, None)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        """Summarize every dirty channel now, batch by batch
+        
+        Channels marked again while this runs (including by summarize_batch itself) wait
+        for the next flush, so a channel the model keeps skipping can't loop here.
+        """
+        pending, self.dirty = self.dirty, {}
+        while pending:
+            batch = [pending.popitem() for _ in range(min(self.batch_size, len(pending)))]
+            try:
+                await self.summarize_batch(batch)
+                self.batches += 1
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"Conversation summary batch failed, will retry: {e}")
+                for channel_id, history in batch + list(pending.items()):
+                    self.dirty.setdefault(channel_id, history)
+                return
+
+class Route:
+    """One row of the model routing table: match conditions, completion settings and usage stats"""
+    def __init__(self, name, model, max_tokens, temperature, commands=None, has_code=None,
+                 is_question=None, min_chars=None, max_chars=None):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.commands = set(commands) if commands else None
+        self.has_code = has_code
+        self.is_question = is_question
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.requests = 0
+        self.latency_total = 0.0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def matches(self, command, features: dict) -> bool:
+        if self.commands is not None and command not in self.commands:
+            return False
+        if self.has_code is not None and features["has_code"] != self.has_code:
+            return False
+        if self.is_question is not None and features["is_question"] != self.is_question:
+            return False
+        if self.min_chars is not None and features["chars"] < self.min_chars:
+            return False
+        if self.max_chars is not None and features["chars"] > self.max_chars:
+            return False
+        return True
+
+    def record(self, latency: float, usage=None):
+        self.requests += 1
+        self.latency_total += latency
+        if usage is not None:
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.completion_tokens += usage.completion_tokens or 0
+            details = getattr(usage, 'prompt_tokens_details', None)
+            self.cached_tokens += getattr(details, 'cached_tokens', None) or 0
+
+    @property
+    def avg_latency(self) -> float:
+        return self.latency_total / self.requests if self.requests else 0.0
+
+    @property
+    def avg_tokens(self) -> float:
+        return (self.prompt_tokens + self.completion_tokens) / self.requests if self.requests else 0.0
+
+class ModelRouter:
+    """Picks the route for a request from a declarative routing table; first matching row wins"""
+    CODE_PATTERN = re.compile(
+        r"```|`[^`\n]+`|\b(def|class|import|return|function|const|let|var|public|static|#include|SELECT)\b|=>|[{};]\s*$",
+        re.MULTILINE
+    )
+    QUESTION_WORDS = {
+        'what', 'why', 'how', 'when', 'where', 'who', 'which', 'whats', 'explain', 'can', 'could',
+        'should', 'is', 'are', 'does', 'do', 'define'
+    }
+
+    def __init__(self, table: list):
+        self.routes = [Route(**row) for row in table]
+
+    def features(self, prompt: str) -> dict:
+        words = re.findall(r"[a-z']+", prompt.lower())
+        return {
+            "chars": len(prompt),
+            "has_code": bool(self.CODE_PATTERN.search(prompt)),
+            "is_question": prompt.rstrip().endswith('?') or bool(words and words[0].replace("'", "") in self.QUESTION_WORDS)
+        }
+
+    def route(self, command, prompt: str) -> Route:
+        features = self.features(prompt)
+        for route in self.routes:
+            if route.matches(command, features):
+                return route
+        return self.routes[-1]
+
+class PrefixTracker:
+    """Checks that the system prefix of each conversation's prompt stays byte-identical between calls
+    
+    The prefix is every leading system message (personality, persona, summary). A change
+    is expected after !persona, !roastmode or a summary refresh; anything else means
+    something volatile has crept into the prefix and provider-side caching is lost.
+    """
+    def __init__(self):
+        self.last = {}  # channel_id -> prefix hash
+        self.stable = 0
+        self.changed = 0
+
+    @staticmethod
+    def prefix_hash(messages: list) -> str:
+        prefix = []
+        for message in messages:
+            if message["role"] != "system":
+                break
+            prefix.append(message["content"])
+        return hashlib.sha256("\x00".join(prefix).encode()).hexdigest()
+
+    def observe(self, channel_id: str, messages: list) -> bool:
+        """Record this call's prefix; returns True if it matches the channel's previous call"""
+        digest = self.prefix_hash(messages)
+        previous = self.last.get(channel_id)
+        self.last[channel_id] = digest
+        if previous is None:
+            return True
+        if previous == digest:
+            self.stable += 1
+            return True
+        self.changed += 1
+        return False
+
+    @property
+    def stability(self) -> float:
+        total = self.stable + self.changed
+        return self.stable / total if total else 1.0
+
+class BanterPool:
+    """Pre-generated banter lines per (sass level, roast mode), topped up in the background
+    
+    `pop` is O(1) and never waits on OpenAI. Every `refill_interval` seconds, while the
+    bot is idle, each pool that has been asked for is refilled up to `size` lines in
+    batches of `batch_size`. Lines older than `max_age` seconds are thrown away.
+    """
+    def __init__(self, generate_batch, is_idle, size=20, batch_size=10, refill_interval=30.0, max_age=6 * 3600):
+        self.generate_batch = generate_batch  # async (key, count) -> list of lines
+        self.is_idle = is_idle
+        self.size = size
+        self.batch_size = batch_size
+        self.refill_interval = refill_interval
+        self.max_age = max_age
+        self.pools = {}  # key -> deque of (created_at, line)
+        self.wanted = set()
+        self.task = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    def pop(self, key):
+        """Take a fresh line from the pool for key, or None if it is empty"""
+        self.wanted.add(key)
+        pool = self.pools.get(key)
+        now = time.monotonic()
+        while pool:
+            created_at, line = pool.popleft()
+            if now - created_at <= self.max_age:
+                self.hits += 1
+                return line
+        self.misses += 1
+        return None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await self.refill()
+            await asyncio.sleep(self.refill_interval)
+
+    async def refill(self):
+        now = time.monotonic()
+        for key in list(self.wanted):
+            pool = self.pools.setdefault(key, deque())
+            while pool and now - pool[0][0] > self.max_age:
+                pool.popleft()
+            while len(pool) < self.size and self.is_idle():
+                try:
+                    lines = await self.generate_batch(key, min(self.batch_size, self.size - len(pool)))
+                except Exception as e:
+                    logger.warning(f"Banter pool refill for {key} failed: {e}")
+                    return
+                if not lines:
+                    break
+                pool.extend((time.monotonic(), line) for line in lines)
+                self.generated += len(lines)
+
+    @property
+    def ready(self) -> int:
+        return sum(len(pool) for pool in self.pools.values())
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+class AdmissionRejected(Exception):
+    """Raised when the admission controller sheds a request instead of queueing it"""
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM request shed, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Global cap on concurrent OpenAI calls with bounded, time-limited wait queues
+    
+    Waiters are queued per key (the guild id) and freed slots are handed out by
+    deficit round-robin, so one busy server can't starve everyone else. Keys with a
+    larger weight get proportionally more of the slots.
+    """
+    MIN_WEIGHT = 0.01
+
+    def __init__(self, limit=8, max_queue=50, max_wait=20.0, max_queue_per_key=20, weights=None):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_queue_per_key = max_queue_per_key
+        self.weights = weights if weights is not None else {}
+        self.active = 0
+        self.queues = {}  # key -> deque of waiter futures
+        self.ring = deque()  # keys with waiters, in round-robin order
+        self.deficits = {}
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.wait_times = deque(maxlen=200)
+        self.avg_hold = 5.0  # EWMA of seconds a slot is held, used for retry hints
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queued
+
+    @property
+    def avg_wait(self) -> float:
+        return sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0.0
+
+    def retry_after(self) -> int:
+        """Rough number of seconds until the current queue drains"""
+        return max(1, math.ceil(self.avg_hold * (self.queue_depth + 1) / max(1, self.limit)))
+
+    def weight(self, key) -> float:
+        # Floored, so a zero or negative weight can't keep next_waiter() spinning forever
+        return max(self.MIN_WEIGHT, self.weights.get(key, 1.0))
+
+    @asynccontextmanager
+    async def slot(self, key=None):
+        """Hold one concurrency slot for the duration of the block"""
+        await self.acquire(key)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.avg_hold = 0.8 * self.avg_hold + 0.2 * (time.monotonic() - started)
+            self.release()
+
+    async def acquire(self, key=None):
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+            self.admitted += 1
+            self.wait_times.append(0.0)
+            return
+        queue = self.queues.get(key)
+        if self.queued >= self.max_queue or (queue and len(queue) >= self.max_queue_per_key):
+            self.shed += 1
+            raise AdmissionRejected(self.retry_after())
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self.enqueue(key, waiter)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # a slot was handed over just as we gave up
+            else:
+                self.dequeue(key, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                self.shed += 1
+                raise AdmissionRejected(self.retry_after())
+            raise
+        self.admitted += 1
+        self.wait_times.append(time.monotonic() - started)
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def wake(self):
+        """Hand free slots to queued waiters"""
+        while self.active < self.limit:
+            waiter = self.next_waiter()
+            if waiter is None:
+                return
+            self.active += 1
+            waiter.set_result(None)
+
+    def enqueue(self, key, waiter):
+        if key not in self.queues:
+            self.queues[key] = deque()
+            self.ring.append(key)
+            # A key that arrives at the head of an empty ring earns its quantum straight away
+            self.deficits[key] = self.weight(key) if len(self.ring) == 1 else 0.0
+        self.queues[key].append(waiter)
+        self.queued += 1
+
+    def dequeue(self, key, waiter):
+        queue = self.queues.get(key)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self.queued -= 1
+
+    def next_waiter(self):
+        """Deficit round-robin over the per-key queues"""
+        while self.ring:
+            key = self.ring[0]
+            queue = self.queues[key]
+            while queue and queue[0].done():
+                queue.popleft()
+                self.queued -= 1
+            if not queue:
+                self.drop_head()
+                continue
+            if self.deficits[key] >= 1:
+                self.deficits[key] -= 1
+                self.queued -= 1
+                waiter = queue.popleft()
+                if not queue:
+                    self.drop_head()
+                return waiter
+            self.ring.rotate(-1)
+            self.deficits[self.ring[0]] += self.weight(self.ring[0])
+        return None
+
+    def drop_head(self):
+        key = self.ring.popleft()
+        del self.queues[key]
+        del self.deficits[key]
+        if self.ring:
+            self.deficits[self.ring[0]] += self.weight(self.ring[0])
+
+class AdaptiveLimit:
+    """Tunes an AdmissionController's concurrency limit from what OpenAI tells us (AIMD)
+    
+    The limit grows by about one slot per limit's worth of successful calls while it is
+    actually in use, and shrinks multiplicatively on 429s, timeouts, rising latency or
+    when the API keys' rate-limit headroom (see ApiKey) is nearly used up.
+    """
+    def __init__(self, controller, min_limit=2, max_limit=32, latency_tolerance=2.0, backoff=0.5, headroom=0.1):
+        self.controller = controller
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance  # latency above baseline * tolerance means we're queueing upstream
+        self.backoff = backoff  # multiplicative decrease on 429s
+        self.headroom = headroom  # back off when less than this fraction of the rate limit remains
+        self.estimate = float(controller.limit)
+        self.baselines = {}  # backend name -> smoothed best-case latency
+        self.last_decrease = 0.0
+        self.history = deque(maxlen=50)  # (timestamp, limit, reason)
+
+    @property
+    def limit(self) -> int:
+        return self.controller.limit
+
+    def on_success(self, latency: float, headroom=None, backend=None):
+        baseline = self.baselines.get(backend)
+        if baseline is None or latency < baseline:
+            baseline = latency
+        else:
+            baseline = 0.98 * baseline + 0.02 * latency  # drift so a lasting shift is accepted
+        self.baselines[backend] = baseline
+        
+        if headroom is not None and headroom < self.headroom:
+            self.decrease(0.9, f"rate limit headroom {headroom:.0%}")
+        elif latency > self.latency_tolerance * baseline:
+            self.decrease(0.9, f"latency {latency:.1f}s vs baseline {baseline:.1f}s")
+        elif self.controller.queue_depth or self.controller.active >= self.controller.limit:
+            self.apply(self.estimate + 1 / self.estimate, "increase")
+
+    def on_throttled(self):
+        self.decrease(self.backoff, "429 from OpenAI")
+
+    def on_overloaded(self, reason: str):
+        self.decrease(0.75, reason)
+
+    def decrease(self, factor: float, reason: str):
+        # One decrease per latency window, so a burst of 429s from the same overload counts once
+        now = time.monotonic()
+        if now - self.last_decrease < max([1.0, *self.baselines.values()]):
+            return
+        self.last_decrease = now
+        self.apply(self.estimate * factor, reason)
+
+    def apply(self, estimate: float, reason: str):
+        self.estimate = min(float(self.max_limit), max(float(self.min_limit), estimate))
+        limit = int(self.estimate)
+        if limit == self.controller.limit:
+            return
+        logger.info(f"LLM concurrency limit {self.controller.limit} -> {limit} ({reason})")
+        self.history.append((time.time(), limit, reason))
+        self.controller.limit = limit
+        self.controller.wake()
+
+class RetryPolicy:
+    """Exponential backoff with full jitter for transient OpenAI failures, honoring Retry-After"""
+    def __init__(self, max_attempts=4, base_delay=0.3, max_delay=8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.outcomes = Counter()  # (attempt number, outcome) -> count
+
+    @staticmethod
+    def classify(error):
+        """Short outcome name for a retryable error, or None if retrying won't help
+        
+        "key" means the API key itself was refused (revoked, or out of quota); the key
+        pool quarantines it and a retry goes out with another key.
+        """
+        if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+            return "key"
+        if isinstance(error, openai.RateLimitError) and error.code == "insufficient_quota":
+            return "key"
+        if isinstance(error, openai.RateLimitError):
+            return "429"
+        if isinstance(error, openai.APITimeoutError):
+            return "timeout"
+        if isinstance(error, openai.APIConnectionError):
+            return "connection"
+        if isinstance(error, openai.APIStatusError) and (error.status_code >= 500 or error.status_code in (408, 409)):
+            return str(error.status_code)
+        return None
+
+    @staticmethod
+    def retry_after(error):
+        """Seconds the server asked us to wait, if it said so"""
+        response = getattr(error, 'response', None)
+        if response is None:
+            return None
+        headers = response.headers
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000
+            if headers.get('retry-after'):
+                value = headers['retry-after']
+                try:
+                    return float(value)
+                except ValueError:
+                    retry_at = parsedate_to_datetime(value)
+                    return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+        return None
+
+    def delay(self, attempt: int, retry_after=None) -> float:
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def record(self, attempt: int, outcome: str):
+        self.outcomes[(attempt, outcome)] += 1
+
+    @property
+    def retried(self) -> int:
+        return sum(count for (attempt, outcome), count in self.outcomes.items() if outcome.startswith("retry"))
+
+    @property
+    def recovered(self) -> int:
+        return sum(count for (attempt, outcome), count in self.outcomes.items() if attempt > 1 and outcome == "ok")
+
+    @property
+    def failed(self) -> int:
+        return sum(count for (attempt, outcome), count in self.outcomes.items() if outcome.startswith("gave up"))
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a backend whose circuit breaker is open"""
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker around a backend
+    
+    After failure_threshold failures within window seconds the circuit opens and calls
+    are refused straight away. A background probe runs every reset_timeout seconds while
+    open (half-open); the first successful probe closes the circuit again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, probe, name="openai", failure_threshold=5, window=30.0, reset_timeout=15.0):
+        self.probe = probe  # async callable that raises if the backend is still down
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = deque()
+        self.trips = 0
+        self.short_circuited = 0
+        self.probe_task = None
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        self.short_circuited += 1
+        return False
+
+    def record_success(self):
+        self.failures.clear()
+        if self.state != self.CLOSED:
+            self.transition(self.CLOSED)
+
+    def record_failure(self):
+        now = time.monotonic()
+        self.failures.append(now)
+        while self.failures and now - self.failures[0] > self.window:
+            self.failures.popleft()
+        if self.state == self.CLOSED and len(self.failures) >= self.failure_threshold:
+            self.trip()
+
+    def trip(self):
+        """Open the circuit and start probing for recovery"""
+        self.trips += 1
+        self.transition(self.OPEN)
+        if self.probe_task is None or self.probe_task.done():
+            self.probe_task = asyncio.create_task(self.probe_until_recovered())
+
+    def transition(self, state: str):
+        logger.warning(f"Circuit breaker '{self.name}': {self.state} -> {state}")
+        self.state = state
+
+    async def probe_until_recovered(self):
+        while self.state != self.CLOSED:
+            await asyncio.sleep(self.reset_timeout)
+            if self.state == self.CLOSED:
+                break  # a request that was still in flight succeeded and closed it meanwhile
+            self.transition(self.HALF_OPEN)
+            try:
+                await self.probe()
+            except Exception as e:
+                logger.warning(f"Circuit breaker '{self.name}' probe failed: {e}")
+                if self.state == self.HALF_OPEN:
+                    self.transition(self.OPEN)
+            else:
+                self.record_success()
+
+class ApiKey:
+    """One API key with its own requests- and tokens-per-minute budget
+    
+    Usage is counted locally over a sliding window and corrected with the
+    x-ratelimit-remaining-* headers of the key's latest response, which also
+    account for traffic from other processes sharing the key.
+    """
+    RESET_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+    def __init__(self, label, client, rpm=3500, tpm=90000, window=60.0):
+        self.label = label
+        self.client = client
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self.sent = deque()  # (timestamp, tokens) reserved within the window
+        self.sent_tokens = 0
+        self.remaining_requests = None  # from the latest response headers
+        self.remaining_tokens = None
+        self.reset_at = 0.0  # when those remaining counts stop applying
+        self.since_requests = 0  # reserved since the headers were read
+        self.since_tokens = 0
+        self.quarantined_until = 0.0
+        self.quarantine_reason = None
+        self.requests = 0
+        self.errors = 0
+
+    def available(self, now: float) -> bool:
+        return now >= self.quarantined_until
+
+    def prune(self, now: float):
+        while self.sent and now - self.sent[0][0] > self.window:
+            self.sent_tokens -= self.sent.popleft()[1]
+
+    def reserve(self, tokens: int, now: float):
+        self.prune(now)
+        self.sent.append((now, tokens))
+        self.sent_tokens += tokens
+        self.since_requests += 1
+        self.since_tokens += tokens
+        self.requests += 1
+
+    def usage(self, now: float) -> float:
+        """Fraction of the tighter budget reserved within the window, by local count only"""
+        self.prune(now)
+        return max(len(self.sent) / self.rpm, self.sent_tokens / self.tpm)
+
+    def headroom(self, now: float) -> float:
+        """Fraction of the tighter of the two budgets still unused"""
+        self.prune(now)
+        request_room = 1 - len(self.sent) / self.rpm
+        token_room = 1 - self.sent_tokens / self.tpm
+        if now < self.reset_at:
+            if self.remaining_requests is not None:
+                request_room = min(request_room, (self.remaining_requests - self.since_requests) / self.rpm)
+            if self.remaining_tokens is not None:
+                token_room = min(token_room, (self.remaining_tokens - self.since_tokens) / self.tpm)
+        return max(0.0, min(request_room, token_room))
+
+    def observe(self, headers):
+        """Take the remaining request/token counts from a response's x-ratelimit-* headers"""
+        if not headers:
+            return
+        remaining = {}
+        resets = []
+        for kind in ('requests', 'tokens'):
+            try:
+                remaining[kind] = float(headers.get(f'x-ratelimit-remaining-{kind}'))
+            except (TypeError, ValueError):
+                continue
+            resets.append(self.parse_reset(headers.get(f'x-ratelimit-reset-{kind}')))
+        if not remaining:
+            return
+        self.remaining_requests = remaining.get('requests')
+        self.remaining_tokens = remaining.get('tokens')
+        self.reset_at = time.monotonic() + max(resets)
+        self.since_requests = 0
+        self.since_tokens = 0
+
+    def throttled(self, seconds: float):
+        """A plain 429: treat the key as spent until the server's retry hint has passed"""
+        self.remaining_requests = 0
+        self.reset_at = time.monotonic() + seconds
+        self.since_requests = 0
+        self.since_tokens = 0
+
+    @classmethod
+    def parse_reset(cls, value) -> float:
+        """Seconds from an OpenAI reset header like "1s", "6m0s" or "120ms" (a full window if missing)"""
+        parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value or "")
+        return sum(float(amount) * cls.RESET_UNITS[unit] for amount, unit in parts) if parts else 60.0
+
+class KeyPool:
+    """A backend's API keys; each request goes to the available key with the most headroom
+    
+    Keys that get auth errors or run out of quota are quarantined for quarantine_time
+    seconds, so requests stop failing on them while the other keys carry the load.
+    """
+    def __init__(self, keys: list, quarantine_time=900.0):
+        self.keys = keys
+        self.quarantine_time = quarantine_time
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    @property
+    def available(self) -> bool:
+        now = time.monotonic()
+        return any(key.available(now) for key in self.keys)
+
+    def headroom(self):
+        """Headroom of the best available key, or None if every key is quarantined"""
+        now = time.monotonic()
+        return max((key.headroom(now) for key in self.keys if key.available(now)), default=None)
+
+    def choose(self, tokens: int) -> ApiKey:
+        """Pick the available key with the most headroom and reserve an estimated tokens on it
+        
+        When every key is out of headroom, the least used one relative to its budget goes.
+        """
+        now = time.monotonic()
+        candidates = [key for key in self.keys if key.available(now)]
+        if not candidates:
+            raise CircuitOpen()
+        key = max(candidates, key=lambda key: (key.headroom(now), -key.usage(now)))
+        key.reserve(tokens, now)
+        return key
+
+    def on_error(self, key: ApiKey, error):
+        key.errors += 1
+        if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+            self.quarantine(key, f"auth error {error.status_code}")
+        elif isinstance(error, openai.RateLimitError) and error.code == "insufficient_quota":
+            self.quarantine(key, "out of quota")
+        elif isinstance(error, openai.RateLimitError):
+            key.throttled(RetryPolicy.retry_after(error) or 1.0)
+
+    def quarantine(self, key: ApiKey, reason: str):
+        key.quarantined_until = time.monotonic() + self.quarantine_time
+        key.quarantine_reason = reason
+        logger.warning(f"API key {key.label} quarantined for {self.quarantine_time:.0f}s: {reason}")
+
+class LLMBackend:
+    """One named OpenAI-compatible chat completions endpoint
+    
+    Either OpenAI itself or a self-hosted server (vLLM, llama.cpp server, ...) speaking
+    the same API. Each backend has its own API keys, concurrency limit, circuit
+    breaker and latency average. Local servers usually host a single model, set
+    with `model`.
+    """
+    def __init__(self, name, keys: KeyPool, max_concurrency=8, weight=1.0, model=None, probe_model="gpt-3.5-turbo",
+                 failure_threshold=5, reset_timeout=15.0):
+        self.name = name
+        self.keys = keys
+        self.max_concurrency = max_concurrency
+        self.weight = weight
+        self.model = model  # serve every route with this model, None = the route's model
+        self.probe_model = probe_model
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.breaker = CircuitBreaker(
+            self.probe,
+            name=name,
+            failure_threshold=failure_threshold,
+            window=30.0,
+            reset_timeout=reset_timeout
+        )
+        self.active = 0  # requests assigned to this backend, including ones waiting for a slot
+        self.latency = None  # EWMA of seconds until the response starts
+        self.requests = 0
+        self.failures = 0
+        self.last_used = 0.0
+
+    def model_for(self, model: str) -> str:
+        return self.model or model
+
+    @property
+    def healthy(self) -> bool:
+        return self.breaker.state == CircuitBreaker.CLOSED and self.keys.available
+
+    @property
+    def full(self) -> bool:
+        return self.active >= self.max_concurrency
+
+    def expected_latency(self) -> float:
+        """Rough seconds until a new request starts getting an answer; 0 until measured so new backends get tried"""
+        return (self.latency or 0.0) * (1 + self.active / self.max_concurrency)
+
+    @asynccontextmanager
+    async def slot(self):
+        self.active += 1
+        try:
+            async with self.slots:
+                self.requests += 1
+                self.last_used = time.monotonic()
+                yield
+        finally:
+            self.active -= 1
+
+    def record_success(self, latency: float):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.failures += 1
+        self.breaker.record_failure()
+
+    def record_error(self, key: ApiKey, error):
+        """Count a failed call against the key pool, and against the breaker if it looks like an outage"""
+        self.keys.on_error(key, error)
+        outcome = RetryPolicy.classify(error)
+        if outcome not in (None, "429", "key"):  # throttling and bad keys don't mean the backend is down
+            self.record_failure()
+        return outcome
+
+    async def probe(self):
+        """Tiny completion to check the backend is up"""
+        key = self.keys.choose(1)
+        await key.client.chat.completions.create(
+            model=self.model_for(self.probe_model),
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1,
+            timeout=10.0,
+        )
+
+class BackendPool:
+    """Named LLM backends behind one interface, picking one for every request
+    
+    The "weighted" strategy spreads requests in proportion to backend weights; "latency"
+    picks the backend expected to answer soonest (scaled by weight). Backends with an
+    open circuit are skipped, and so are full ones while another backend has room. A
+    background health check probes backends that haven't served traffic for a while.
+    """
+    def __init__(self, backends: list, strategy="weighted", health_interval=30.0):
+        self.backends = {backend.name: backend for backend in backends}
+        self.strategy = strategy
+        self.health_interval = health_interval
+        self.short_circuited = 0
+        self.task = None
+
+    def __iter__(self):
+        return iter(self.backends.values())
+
+    def allow(self) -> bool:
+        if any(backend.healthy for backend in self):
+            return True
+        self.short_circuited += 1
+        return False
+
+    def choose(self, exclude=()) -> LLMBackend:
+        """Pick a backend, preferring ones not in exclude (e.g. already tried for this request)"""
+        healthy = [backend for backend in self if backend.healthy]
+        if not healthy:
+            self.short_circuited += 1
+            raise CircuitOpen()
+        candidates = [backend for backend in healthy if backend.name not in exclude] or healthy
+        candidates = [backend for backend in candidates if not backend.full] or candidates
+        if self.strategy == "latency":
+            return min(candidates, key=lambda backend: backend.expected_latency() / backend.weight)
+        return random.choices(candidates, weights=[backend.weight for backend in candidates])[0]
+
+    @property
+    def trips(self) -> int:
+        return sum(backend.breaker.trips for backend in self)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for backend in self:
+            if backend.breaker.probe_task:
+                backend.breaker.probe_task.cancel()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
+
+    async def check_health(self):
+        """Probe idle healthy backends; one that fails is taken out until its breaker's probe succeeds"""
+        now = time.monotonic()
+        for backend in self:
+            if not backend.healthy or now - backend.last_used < self.health_interval:
+                continue
+            try:
+                await backend.probe()
+            except Exception as e:
+                logger.warning(f"LLM backend '{backend.name}' failed its health check: {e}")
+                if backend.healthy:
+                    backend.breaker.trip()
+
+class HedgePolicy:
+    """Decides when a slow completion gets a backup request, within an extra-request budget
+    
+    The hedge threshold is the given percentile of recently observed first-response
+    latency (first streamed token, or the whole response when not streaming).
+    """
+    def __init__(self, enabled=False, percentile=95, budget=0.05, min_samples=50):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget  # max hedges as a fraction of requests
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=500)
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def threshold(self):
+        """Seconds to wait before hedging, or None if hedging is off or we lack data"""
+        if not self.enabled or len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def allow(self) -> bool:
+        return self.hedges + 1 <= self.budget * self.requests
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedges / self.requests if self.requests else 0.0
+
+    @property
+    def win_rate(self) -> float:
+        return self.wins / self.hedges if self.hedges else 0.0
+
+class SingleFlight:
+    """Coalesces concurrent identical requests so they share one in-flight call
+    
+    The shared call runs as its own task; every caller awaits it and receives the
+    streamed text through its own on_delta. The call is only cancelled once every
+    caller waiting on it has gone away.
+    """
+    class Flight:
+        def __init__(self):
+            self.task = None
+            self.subscribers = []
+            self.text = ""
+            self.waiters = 0
+
+        async def broadcast(self, text: str):
+            self.text = text
+            for subscriber in list(self.subscribers):
+                await subscriber(text)
+
+    def __init__(self):
+        self.flights = {}
+        self.calls = 0
+        self.saved = 0
+
+    async def do(self, key: str, call, on_delta=None):
+        """Run call(on_delta) for key, or join the call already in flight for it"""
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = self.Flight()
+            self.calls += 1
+            flight.task = asyncio.create_task(call(flight.broadcast if on_delta else None))
+            flight.task.add_done_callback(lambda task: self.finish(key, flight))
+        else:
+            self.saved += 1
+            if on_delta and flight.text:
+                await on_delta(flight.text)  # catch up on what has streamed so far
+        
+        if on_delta:
+            flight.subscribers.append(on_delta)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if on_delta:
+                flight.subscribers.remove(on_delta)
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def finish(self, key: str, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        if not flight.task.cancelled():
+            flight.task.exception()  # mark as retrieved; callers re-raise it themselves
+
+class ResponseCache:
+    """Exact-match response cache with TTL expiry and LRU eviction under entry and byte budgets"""
+    def __init__(self, max_entries=2000, max_bytes=8 * 1024 * 1024, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, response, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(messages: list, model: str, temperature: float, roast_mode: bool) -> str:
+        payload = json.dumps(messages, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(f"{model}|{round(temperature, 1)}|{roast_mode}|{payload}".encode()).hexdigest()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, response, size = entry
+        if time.monotonic() >= expires_at:
+            self.remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key: str, response: str):
+        if key in self.entries:
+            self.remove(key)
+        size = len(key) + len(response.encode())
+        self.entries[key] = (time.monotonic() + self.ttl, response, size)
+        self.bytes += size
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key: str):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+class OpenAIEmbedder:
+    """Embeddings from the OpenAI embeddings endpoint"""
+    def __init__(self, client, model="text-embedding-3-small", dim=1536):
+        self.client = client
+        self.model = model
+        self.dim = dim
+
+    async def embed(self, text: str) -> np.ndarray:
+        response = await self.client.embeddings.create(model=self.model, input=text)
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+class SemanticIndex:
+    """Unit vectors in one contiguous matrix; a lookup is a single matrix-vector product"""
+    def __init__(self, dim: int, capacity: int, ttl: float):
+        self.dim = dim
+        self.capacity = capacity
+        self.ttl = ttl
+        self.matrix = np.zeros((min(64, capacity), dim), dtype=np.float32)
+        self.last_used = np.zeros(len(self.matrix), dtype=np.float64)
+        self.expires = np.zeros(len(self.matrix), dtype=np.float64)
+        self.responses = []
+        self.size = 0
+
+    def lookup(self, vector: np.ndarray, threshold: float):
+        if not self.size:
+            return None
+        scores = self.matrix[:self.size] @ vector
+        best = int(np.argmax(scores))
+        now = time.monotonic()
+        if scores[best] < threshold or self.expires[best] <= now:
+            return None
+        self.last_used[best] = now
+        return self.responses[best]
+
+    def insert(self, vector: np.ndarray, response: str) -> bool:
+        """Store a response; returns True if an older entry had to be evicted"""
+        now = time.monotonic()
+        evicted = False
+        if self.size < self.capacity:
+            if self.size == len(self.matrix):
+                self.grow()
+            slot = self.size
+            self.size += 1
+            self.responses.append(response)
+        else:
+            # Reuse an expired slot if there is one, otherwise the least recently used
+            expired = np.flatnonzero(self.expires[:self.size] <= now)
+            slot = int(expired[0]) if len(expired) else int(np.argmin(self.last_used[:self.size]))
+            self.responses[slot] = response
+            evicted = True
+        self.matrix[slot] = vector
+        self.last_used[slot] = now
+        self.expires[slot] = now + self.ttl
+        return evicted
+
+    def grow(self):
+        rows = min(self.capacity, len(self.matrix) * 2)
+        self.matrix = np.resize(self.matrix, (rows, self.dim))
+        self.last_used = np.resize(self.last_used, rows)
+        self.expires = np.resize(self.expires, rows)
+
+class SemanticCache:
+    """Answers rephrased questions from earlier answers, one index per namespace (guild and conversation)"""
+    def __init__(self, embedder, threshold=0.85, capacity_per_namespace=5000, ttl=24 * 3600):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.capacity_per_namespace = capacity_per_namespace
+        self.ttl = ttl
+        self.namespaces = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, namespace, question: str):
+        """Return (cached response or None, embedding) so a miss can be stored without re-embedding"""
+        vector = await self.embedder.embed(question)
+        index = self.namespaces.get(namespace)
+        response = index.lookup(vector, self.threshold) if index else None
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response, vector
+
+    def put(self, namespace, vector: np.ndarray, response: str):
+        index = self.namespaces.get(namespace)
+        if index is None:
+            index = self.namespaces[namespace] = SemanticIndex(len(vector), self.capacity_per_namespace, self.ttl)
+        if index.insert(vector, response):
+            self.evictions += 1
+
+    @property
+    def entries(self) -> int:
+        return sum(index.size for index in self.namespaces.values())
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
 class AIDiscordBot:
     """Jyle - Your AI Discord Bot with Personality and Teacher DM Feature"""
     def __init__(self):
@@ -23,9 +1789,47 @@ class AIDiscordBot:
         self.bot_token = os.getenv('DISCORD_BOT_TOKEN')
         self.openai_api_key = os.getenv('OPENAI_API_KEY')
         self.teacher_id = os.getenv('TEACHER_DISCORD_ID')
+        self.teacher_id_override = None  # set with !set_teacher; snapshots keep it unless TEACHER_DISCORD_ID changes
+        
+        self.openai_base_url = os.getenv('OPENAI_BASE_URL')
         
-        # Set up OpenAI client
-        self.openai_client = OpenAI(api_key=self.openai_api_key)
+        # API keys - OPENAI_API_KEYS="sk-aaa:3500:90000,sk-bbb:500:40000" (key:rpm:tpm) spreads OpenAI
+        # traffic over several keys, each with its own budget. Keys that get auth or quota errors
+        # are quarantined for key_quarantine_time seconds. Without OPENAI_API_KEY, the first of
+        # them also backs the default client (health probes, embeddings)
+        self.key_default_rpm = 3500
+        self.key_default_tpm = 90000
+        self.key_quarantine_time = 900.0
+        self.openai_api_keys = self.parse_api_keys(
+            os.getenv('OPENAI_API_KEYS', self.openai_api_key or ''),
+            self.key_default_rpm,
+            self.key_default_tpm
+        )
+        if not self.openai_api_key and self.openai_api_keys:
+            self.openai_api_key = self.openai_api_keys[0][0]
+        
+        # OpenAI connection pool settings (shared by every completion)
+        self.openai_max_connections = 100
+        self.openai_max_keepalive_connections = 20
+        self.openai_keepalive_expiry = 30.0
+        self.openai_connect_timeout = 5.0
+        self.openai_read_timeout = 60.0
+        
+        # Set up OpenAI client - async, so concurrent completions cost coroutines instead of threads
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.openai_max_connections,
+                max_keepalive_connections=self.openai_max_keepalive_connections,
+                keepalive_expiry=self.openai_keepalive_expiry
+            ),
+            timeout=httpx.Timeout(self.openai_read_timeout, connect=self.openai_connect_timeout)
+        )
+        self.openai_client = AsyncOpenAI(
+            api_key=self.openai_api_key,
+            base_url=self.openai_base_url,
+            http_client=self.http_client,
+            max_retries=0  # retries are handled by self.retry_policy so they respect the deadline
+        )
         
         # Bot intents
         intents = discord.Intents.default()
@@ -36,20 +1840,201 @@ class AIDiscordBot:
         # Create bot instance
         self.bot = commands.Bot(command_prefix='!', intents=intents)
         
-        # AI conversation history (in-memory storage)
-        self.conversations = {}
+        # AI conversation history (in-memory storage) - idle conversations expire and the least recently
+        # used ones are evicted once the store goes over its entry or byte budget, shared by all keys
+        # Scope (JYLE_CONVERSATION_SCOPE): 'channel' keeps one history per channel (a Discord thread
+        # counts as a channel), 'user' one per (channel, user), and 'thread' one per Discord thread,
+        # with messages outside threads kept per (channel, user)
+        self.conversation_scope = os.getenv('JYLE_CONVERSATION_SCOPE', 'channel')
+        if self.conversation_scope not in ('channel', 'user', 'thread'):
+            logger.warning(f"Unknown JYLE_CONVERSATION_SCOPE {self.conversation_scope!r}, using 'channel'")
+            self.conversation_scope = 'channel'
+        self.conversation_max_entries = 20000
+        self.conversation_max_bytes = 64 * 1024 * 1024
+        self.conversation_idle_ttl = 7 * 24 * 3600
+        self.conversations = ConversationStore(
+            max_entries=self.conversation_max_entries,
+            max_bytes=self.conversation_max_bytes,
+            idle_ttl=self.conversation_idle_ttl,
+            sweep_interval=60.0
+        )
+        
+        # Durable store - set JYLE_DB_PATH to keep conversations, nicknames and roast mode in
+        # SQLite across restarts; channels evicted from memory are reloaded on their next message
+        self.durable_path = os.getenv('JYLE_DB_PATH')
+        self.durable = DurableStore(self.durable_path, batch_size=1000, keep_turns=200) if self.durable_path else None
+        
+        # State snapshots - set JYLE_SNAPSHOT_PATH to snapshot conversations and settings every
+        # snapshot_interval seconds and on shutdown, and restore them on boot before connecting
+        self.snapshot_path = os.getenv('JYLE_SNAPSHOT_PATH')
+        self.snapshot_interval = 60.0
+        self.snapshots = StateSnapshot(self.snapshot_path, self.collect_state, self.snapshot_interval) if self.snapshot_path else None
         
         # Bot settings
         self.ai_model = "gpt-3.5-turbo" 
         self.max_tokens = 500
         self.temperature = 0.9
         
+        # Jyle's personality. Kept free of per-user details so every prompt starts with the
+        # same bytes and the provider's prompt prefix cache can kick in (see build_messages)
+        self.personalities = {
+            True: "You are Jyle, a sassy, witty AI assistant with a playful roasting personality. You love friendly banter and gentle teasing, but you're never truly mean. You use humor, tech jokes, and clever comebacks. Keep it fun and lighthearted.",
+            False: "You are Jyle, a fun, engaging AI assistant who loves banter and humor. You're witty but friendly, use tech jokes and memes when appropriate, and have a playful personality. You occasionally throw in some gentle teasing but always stay positive."
+        }
+        self.prefix_tracker = PrefixTracker()
+        
+        # Model routing - model, max_tokens and temperature are picked per command and prompt
+        # features (length, code, question words). Rows are tried in order; the last is the fallback
+        self.routing_table = [
+            # Code gets a stronger model, room for a full answer and a steadier temperature
+            {"name": "code", "commands": {"jyle", "question"}, "has_code": True, "model": "gpt-4o-mini", "max_tokens": 800, "temperature": 0.3},
+            # Questions for the teacher queue deserve a proper explanation, with less improvising
+            {"name": "question", "commands": {"question"}, "model": self.ai_model, "max_tokens": 600, "temperature": 0.5},
+            # Quick banter ("!jyle lol") doesn't need 500 tokens
+            {"name": "banter", "commands": {"jyle", "banter"}, "is_question": False, "max_chars": 80, "model": self.ai_model, "max_tokens": 150, "temperature": 1.0},
+            {"name": "default", "model": self.ai_model, "max_tokens": self.max_tokens, "temperature": self.temperature},
+        ]
+        self.router = ModelRouter(self.routing_table)
+        
+        # History window - oldest messages are dropped once a channel's history goes over
+        # history_token_budget, or over what's left of the context window after the
+        # system prompt and the reply (max_tokens)
+        self.context_window = 16385
+        self.history_token_budget = 3000
+        self.system_prompt_reserve = 200
+        
+        # Rolling summaries - turns that fall out of the history window are folded into a
+        # short per-channel summary in the background, sent as one system message
+        self.summaries_enabled = True
+        self.summary_max_evicted = 100
+        self.summarizer = ConversationSummarizer(self.summarize_histories, interval=15.0, batch_size=8)
+        
+        # LLM admission settings - caps concurrent OpenAI calls, extra requests queue or get shed.
+        # The limit starts at llm_concurrency_limit and adapts between the min and max.
+        self.llm_concurrency_limit = 8
+        self.llm_min_concurrency = 2
+        self.llm_max_concurrency = 32
+        self.llm_max_queue = 50
+        self.llm_max_wait = 20.0
+        self.llm_max_queue_per_guild = 20
+        # Optional fair-share weights, e.g. LLM_GUILD_WEIGHTS="1234567890:2,9876543210:0.5"
+        self.guild_weights = self.parse_guild_weights(os.getenv('LLM_GUILD_WEIGHTS', ''))
+        self.admission = AdmissionController(
+            limit=self.llm_concurrency_limit,
+            max_queue=self.llm_max_queue,
+            max_wait=self.llm_max_wait,
+            max_queue_per_key=self.llm_max_queue_per_guild,
+            weights=self.guild_weights
+        )
+        self.concurrency = AdaptiveLimit(
+            self.admission,
+            min_limit=self.llm_min_concurrency,
+            max_limit=self.llm_max_concurrency
+        )
+        
+        # Retry settings - transient errors are retried with jittered backoff, but a
+        # request never takes longer than llm_deadline seconds in total
+        self.llm_deadline = 45.0
+        
+        # Per-command deadlines (override llm_deadline). With partial_responses on, a reply still
+        # streaming at its deadline - or failing halfway - is sent as far as it got, with
+        # cut_short_marker, and the rest of the generation is cancelled so we stop paying for it
+        self.command_deadlines = {'jyle': 25.0, 'question': 40.0, 'banter': 10.0}
+        self.partial_responses = True
+        self.cut_short_marker = "… *(cut short)* ✂️"
+        self.cut_short = 0
+        self.retry_policy = RetryPolicy(max_attempts=4, base_delay=0.3, max_delay=8.0)
+        
+        # LLM backends - completions go to one of these OpenAI-compatible endpoints, each with its
+        # own concurrency limit and circuit breaker (during an outage of every backend we reply
+        # instantly instead of waiting on timeouts). Set LOCAL_LLM_BASE_URL to a self-hosted server
+        # (vLLM, llama.cpp server) to send part of the traffic there. Strategy: "weighted" or "latency"
+        self.backend_strategy = os.getenv('LLM_BACKEND_STRATEGY', 'weighted')
+        self.backend_health_interval = 30.0
+        self.backend_specs = [
+            {"name": "openai", "base_url": self.openai_base_url, "api_keys": self.openai_api_keys, "max_concurrency": 32, "weight": 1.0},
+        ]
+        if os.getenv('LOCAL_LLM_BASE_URL'):
+            self.backend_specs.append({
+                "name": "local",
+                "base_url": os.getenv('LOCAL_LLM_BASE_URL'),
+                "api_keys": [(os.getenv('LOCAL_LLM_API_KEY', 'local'), self.key_default_rpm, self.key_default_tpm)],
+                "model": os.getenv('LOCAL_LLM_MODEL'),
+                "max_concurrency": int(os.getenv('LOCAL_LLM_CONCURRENCY', '4')),
+                "weight": float(os.getenv('LOCAL_LLM_WEIGHT', '1.0'))
+            })
+        self.backends = BackendPool(
+            [self.make_backend(spec) for spec in self.backend_specs],
+            strategy=self.backend_strategy,
+            health_interval=self.backend_health_interval
+        )
+        
+        # Request hedging - fire a backup request when the first one is slower than
+        # the hedge percentile, spending at most hedge_budget extra requests
+        self.hedging = HedgePolicy(enabled=False, percentile=95, budget=0.05)
+        
+        # Identical prompts in flight at the same time share one completion. Only commands in
+        # coalesce_commands take part; they are answered without channel history or the asker's
+        # name, so one reply fits everyone who asked ("everyone ask Jyle what a closure is")
+        self.single_flight = SingleFlight()
+        self.coalesce_commands = {'question'}
+        
+        # In-flight !jyle / !question generations, cancelled when the triggering message is
+        # deleted or the channel's history is cleared
+        self.generations = GenerationTracker()
+        
+        # Response cache - exact repeats of a prompt are answered without calling OpenAI.
+        # Opt-in per command (cache_commands) or per channel (!cache)
+        self.response_cache = ResponseCache(max_entries=2000, max_bytes=8 * 1024 * 1024, ttl=24 * 3600)
+        self.cache_commands = {'question'}
+        self.cache_channels = set()
+        
+        # Semantic cache - rephrasings of an earlier question ("what's a closure?" vs "can you
+        # explain closures") reuse its answer. Same opt-in as the response cache, per conversation so
+        # an answer shaped by one conversation isn't served in another. Off unless JYLE_SEMANTIC_CACHE
+        # is set, since it needs model-quality embeddings to tell "10 miles to km" from "10 km to miles"
+        self.semantic_cache_enabled = bool(os.getenv('JYLE_SEMANTIC_CACHE'))
+        self.semantic_embed_timeout = 2.0  # also capped by the command's deadline
+        self.semantic_cache = SemanticCache(OpenAIEmbedder(self.openai_client), threshold=0.9, capacity_per_namespace=5000)
+        
+        # Streaming settings - replies are edited in place as tokens arrive
+        self.stream_responses = True
+        self.stream_edit_interval = 1.0
+        self.stream_edit_chars = 40
+        
         # Banter settings
         self.banter_chance = 0.25
         self.roast_mode = {}
         self.user_nicknames = {}
         self.sass_level = "maximum"
         
+        # Banter pool - !banter lines are generated ahead of time in batches while the bot is
+        # idle, so the command answers instantly
+        self.banter_pool = BanterPool(
+            self.generate_banter,
+            self.llm_idle,
+            size=20,
+            batch_size=10,
+            refill_interval=30.0,
+            max_age=6 * 3600
+        )
+        self.banter_pool.wanted.update({(self.sass_level, False), (self.sass_level, True)})
+        
+        self.memes = [
+            "That's what she said! 😏 (I had to, it was right there)",
+            "Instructions unclear, got Jyle stuck in the matrix 🌀",
+            "Task failed successfully! Just like your last attempt ✅❌",
+            "This is fine 🔥🐕🔥 (narrator: it was not fine)",
+            "Have you tried turning your brain off and on again? 🧠🔌",
+            "Error 404: Your common sense not found 😴",
+            "Achievement unlocked: Successfully confused the AI (not impressed) 🏆",
+            "I'm not a robot... I'm better than a robot 🤖💅",
+            "Press F to pay respects... to your dignity 📱💀",
+            "It's not a bug, it's a 'creative feature'! 🐛➡️✨",
+            "Big oof energy right there 💀",
+            "And I took that personally 😤✨"
+        ]
+        
         # Teacher DM settings
         self.dm_teacher_on_commands = ['jyle', 'question', 'help_request']
         self.teacher_dm_enabled = True
@@ -62,6 +2047,39 @@ class AIDiscordBot:
         self.setup_events()
         self.setup_commands()
     
+    @staticmethod
+    def parse_guild_weights(spec: str) -> dict:
+        """Parse "guild_id:weight,guild_id:weight" into {guild_id: weight}"""
+        weights = {}
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            try:
+                guild_id, weight = item.split(':')
+                weight = float(weight)
+                if not 0 < weight < math.inf:
+                    raise ValueError(weight)
+                weights[int(guild_id)] = weight
+            except ValueError:
+                logger.warning(f"Ignoring invalid LLM_GUILD_WEIGHTS entry: {item}")
+        return weights
+    
+    @staticmethod
+    def parse_api_keys(spec: str, default_rpm: int, default_tpm: int) -> list:
+        """Parse "key:rpm:tpm,key" into [(key, rpm, tpm)], filling in default budgets"""
+        keys = []
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            try:
+                key, *budget = item.strip().split(':')
+                rpm = int(budget[0]) if len(budget) > 0 and budget[0] else default_rpm
+                tpm = int(budget[1]) if len(budget) > 1 and budget[1] else default_tpm
+                keys.append((key, rpm, tpm))
+            except ValueError:
+                logger.warning(f"Ignoring invalid OPENAI_API_KEYS entry ending in ...{item.strip()[-4:]}")
+        return keys
+    
     async def send_teacher_dm(self, user, channel, question, command_used):
         """Send a DM to the teacher with the student's question and context."""
         if not self.teacher_id or not self.teacher_dm_enabled:
@@ -221,6 +2239,17 @@ class AIDiscordBot:
 
             # Process commands
             await self.bot.process_commands(message)
+        
+        # Raw events fire for every deletion, not just messages still in discord.py's cache
+        @self.bot.event
+        async def on_raw_message_delete(payload):
+            if self.generations.cancel_message(payload.message_id):
+                logger.info(f"Cancelled generation for deleted message {payload.message_id}")
+        
+        @self.bot.event
+        async def on_raw_bulk_message_delete(payload):
+            for message_id in payload.message_ids:
+                self.generations.cancel_message(message_id)
 
     def setup_commands(self):        
         @self.bot.command(name='jyle', help='Chat with Jyle - Teacher will be notified')
@@ -231,41 +2260,45 @@ class AIDiscordBot:
                     await self.send_teacher_dm(ctx.author, ctx.channel, message, 'jyle')
                 
                 async with ctx.typing():
-                    channel_id = str(ctx.channel.id)
-                    if channel_id not in self.conversations:
-                        self.conversations[channel_id] = []
+                    key = self.conversation_key(ctx)
+                    history = await self.conversation(key)
                     
-                    self.conversations[channel_id].append({
-                        "role": "user",
-                        "content": f"{ctx.author.display_name}: {message}"
-                    })
+                    turn = self.append_turn(key, history, "user", f"{ctx.author.display_name}: {message}")
+                    self.trim_history(key, history)
                     
-                    if len(self.conversations[channel_id]) > 10:
-                        self.conversations[channel_id] = self.conversations[channel_id][-10:]
+                    reply = self.streaming_reply(ctx)
+                    try:
+                        with self.generations.track(key, ctx.message.id):
+                            jyle_response = await self.get_jyle_response(
+                                history.messages(),
+                                ctx.author.display_name,
+                                str(ctx.channel.id),
+                                ctx,
+                                on_delta=reply.update if self.stream_responses else None,
+                                conversation_key=key
+                            )
+                    except asyncio.CancelledError:
+                        self.remove_turn(key, history, turn)
+                        await reply.discard()
+                        raise
                     
-                    jyle_response = await self.get_jyle_response(
-                        self.conversations[channel_id],
-                        ctx.author.display_name,
-                        str(ctx.channel.id),
-                        ctx
-                    )
-                    
-                    self.conversations[channel_id].append({
-                        "role": "assistant",
-                        "content": jyle_response
-                    })
+                    self.append_turn(key, history, "assistant", jyle_response)
                     
-                    if len(jyle_response) > 2000:
-                        chunks = [jyle_response[i:i+2000] for i in range(0, len(jyle_response), 2000)]
-                        for chunk in chunks:
-                            await ctx.send(chunk)
-                    else:
-                        await ctx.send(jyle_response)
+                    await reply.finish(jyle_response)
                         
             except Exception as e:
                 logger.error(f"Error in jyle_chat command: {e}")
                 await ctx.send("Sorry, I encountered an error while processing your request. Please try again!")
         
+        def quick_response_embed(text):
+            embed = discord.Embed(
+                title="🤖 Jyle's Quick Response",
+                description=text,
+                color=0x00ff00
+            )
+            embed.set_footer(text="Your teacher will provide the official answer soon!")
+            return embed
+        
         @self.bot.command(name='question', help='Ask a question - Teacher will be notified')
         async def ask_question(ctx, *, question: str):
             """Dedicated question command that always notifies the teacher"""
@@ -274,35 +2307,32 @@ class AIDiscordBot:
             await ctx.send(f"📚 **Question received!** Your teacher has been notified.\n\n**Your question:** {question}\n\n*I'll also try to help while you wait for your teacher's response:*")
             
             async with ctx.typing():
-                channel_id = str(ctx.channel.id)
-                if channel_id not in self.conversations:
-                    self.conversations[channel_id] = []
+                key = self.conversation_key(ctx)
+                history = await self.conversation(key)
                 
-                self.conversations[channel_id].append({
-                    "role": "user",
-                    "content": f"{ctx.author.display_name}: {question}"
-                })
+                turn = self.append_turn(key, history, "user", f"{ctx.author.display_name}: {question}")
+                self.trim_history(key, history)
                 
                 try:
-                    ai_response = await self.get_jyle_response(
-                        self.conversations[channel_id],
-                        ctx.author.display_name,
-                        str(ctx.channel.id),
-                        ctx
-                    )
+                    reply = self.streaming_reply(ctx, embed_factory=quick_response_embed)
+                    try:
+                        with self.generations.track(key, ctx.message.id):
+                            ai_response = await self.get_jyle_response(
+                                history.messages(),
+                                ctx.author.display_name,
+                                str(ctx.channel.id),
+                                ctx,
+                                on_delta=reply.update if self.stream_responses else None,
+                                conversation_key=key
+                            )
+                    except asyncio.CancelledError:
+                        self.remove_turn(key, history, turn)
+                        await reply.discard()
+                        raise
                     
-                    self.conversations[channel_id].append({
-                        "role": "assistant",
-                        "content": ai_response
-                    })
+                    self.append_turn(key, history, "assistant", ai_response)
                     
-                    embed = discord.Embed(
-                        title="🤖 Jyle's Quick Response",
-                        description=ai_response,
-                        color=0x00ff00
-                    )
-                    embed.set_footer(text="Your teacher will provide the official answer soon!")
-                    await ctx.send(embed=embed)
+                    await reply.finish(ai_response)
                     
                 except Exception as e:
                     logger.error(f"Error getting AI response for question command: {e}")
@@ -334,30 +2364,40 @@ class AIDiscordBot:
             """Set the teacher's Discord ID"""
             try:
                 teacher = await self.bot.fetch_user(int(user_id))
-                self.teacher_id = user_id
+                self.teacher_id = self.teacher_id_override = user_id
                 await ctx.send(f"✅ Teacher set to: {teacher.name}#{teacher.discriminator}")
             except Exception:
                 await ctx.send("❌ Invalid user ID. Please provide a valid Discord user ID.")
         
         @self.bot.command(name='clear', help='Clear conversation history')
         async def clear_history(ctx):
-            """Clear conversation history for the current channel"""
-            channel_id = str(ctx.channel.id)
-            if channel_id in self.conversations:
-                del self.conversations[channel_id]
+            """Clear the conversation history the caller is in (the channel's, or their own in the 'user' scope)"""
+            key = self.conversation_key(ctx)
+            cancelled = self.generations.cancel_channel(key)
+            if cancelled:
+                logger.info(f"!clear cancelled {cancelled} in-flight generations in conversation {key}")
+            cleared = self.conversations.pop(key) is not None
+            self.summarizer.forget(key)
+            if self.durable:
+                self.durable.clear(key)
+                cleared = True  # the channel may only have history on disk
+            if cleared:
                 await ctx.send("🗑️ Conversation history cleared!")
             else:
                 await ctx.send("No conversation history to clear.")
         
         @self.bot.command(name='persona', help='Set AI personality')
         async def set_persona(ctx, *, persona: str):
-            """Set a custom persona for the AI"""
-            channel_id = str(ctx.channel.id)
+            """Set a custom persona for the AI in the caller's conversation"""
+            key = self.conversation_key(ctx)
             
-            self.conversations[channel_id] = [{
-                "role": "system",
-                "content": f"You are Jyle, an AI assistant with this personality: {persona}. Respond accordingly while being helpful and engaging."
-            }]
+            self.summarizer.forget(key)
+            history = self.conversations[key] = ConversationHistory(
+                persona=f"You are Jyle, an AI assistant with this personality: {persona}. Respond accordingly while being helpful and engaging."
+            )
+            if self.durable:
+                self.durable.clear(key)
+                self.durable.set_channel(key, history.persona, None)
             
             await ctx.send(f"🎭 Jyle's persona set to: {persona}")
         
@@ -444,7 +2484,7 @@ class AIDiscordBot:
             
             embed.add_field(
                 name="Admin Commands",
-                value="`!toggle_teacher_dm` - Toggle teacher notifications\n`!set_teacher <user_id>` - Set teacher Discord ID",
+                value="`!toggle_teacher_dm` - Toggle teacher notifications\n`!set_teacher <user_id>` - Set teacher Discord ID\n`!cache` - Toggle response caching for this channel",
                 inline=False
             )
             
@@ -527,32 +2567,37 @@ class AIDiscordBot:
                 return
             
             self.user_nicknames[str(ctx.author.id)] = nickname
+            if self.durable:
+                self.durable.set_setting('nickname', str(ctx.author.id), nickname)
             await ctx.send(f"Nickname set! Jyle will now call you **{nickname}** (you're welcome) 🏷️💅")
         
         @self.bot.command(name='banter', help='Get some random banter')
         async def random_banter_command(ctx):
             """Get some random banter on demand"""
-            # This function is not defined in the provided code, so I'm removing the call or adding a placeholder.
-            # Assuming you might want to call the get_jyle_response with some banter prompt.
-            # For now, let's just send a simple message.
-            await ctx.send("Here's some random banter for you! 😄")
-
-            # If you want AI-generated banter, you'd need something like:
-            # try:
-            #     channel_id = str(ctx.channel.id)
-            #     banter_prompt = "Give me a short, witty, and sassy piece of banter."
-            #     # Temporarily add to conversation for AI context, or use a fresh list
-            #     temp_conversation = [{"role": "user", "content": banter_prompt}]
-            #     banter_response = await self.get_jyle_response(
-            #         temp_conversation,
-            #         ctx.author.display_name,
-            #         channel_id,
-            #         ctx
-            #     )
-            #     await ctx.send(banter_response)
-            # except Exception as e:
-            #     logger.error(f"Error getting banter: {e}")
-            #     await ctx.send("Couldn't fetch banter right now, my circuits are tangled! 😬")
+            channel_id = str(ctx.channel.id)
+            banter = self.banter_pool.pop((self.sass_level, self.roast_mode.get(channel_id, False)))
+            if banter is None:
+                # Pool is empty - generate one on the spot
+                async with ctx.typing():
+                    banter = await self.get_jyle_response(
+                        [{"role": "user", "content": "Give me a short, witty, and sassy piece of banter."}],
+                        ctx.author.display_name,
+                        channel_id,
+                        ctx
+                    )
+            await ctx.send(banter)
+        
+        @self.bot.command(name='cache', help='Toggle response caching for this channel (Admin only)')
+        @commands.has_permissions(administrator=True)
+        async def toggle_cache(ctx):
+            """Toggle exact-match response caching for !jyle in this channel"""
+            channel_id = str(ctx.channel.id)
+            if channel_id in self.cache_channels:
+                self.cache_channels.discard(channel_id)
+                await ctx.send("🧊 Response caching **disabled** for this channel - every answer will be freshly made 💅")
+            else:
+                self.cache_channels.add(channel_id)
+                await ctx.send("⚡ Response caching **enabled** for this channel - repeat questions get instant answers ✨")
         
         @self.bot.command(name='roastmode', help='Toggle roast mode')
         async def toggle_roast_mode(ctx):
@@ -560,6 +2605,8 @@ class AIDiscordBot:
             channel_id = str(ctx.channel.id)
             current_mode = self.roast_mode.get(channel_id, False)
             self.roast_mode[channel_id] = not current_mode
+            if self.durable:
+                self.durable.set_setting('roast_mode', channel_id, '1' if self.roast_mode[channel_id] else None)
             
             if self.roast_mode[channel_id]:
                 await ctx.send("🌶️ **ROAST MODE ACTIVATED** 🌶️\nJyle's sass levels are now at MAXIMUM. Prepare for destruction! Use `!roastmode` again if you can't handle the heat 💅🔥")
@@ -569,22 +2616,7 @@ class AIDiscordBot:
         @self.bot.command(name='meme', help='Get a random meme response')
         async def meme_response(ctx):
             """Send a random meme-style response"""
-            memes = [
-                "That's what she said! 😏 (I had to, it was right there)",
-                "Instructions unclear, got Jyle stuck in the matrix 🌀",
-                "Task failed successfully! Just like your last attempt ✅❌",
-                "This is fine 🔥🐕🔥 (narrator: it was not fine)",
-                "Have you tried turning your brain off and on again? 🧠🔌",
-                "Error 404: Your common sense not found 😴",
-                "Achievement unlocked: Successfully confused the AI (not impressed) 🏆",
-                "I'm not a robot... I'm better than a robot 🤖💅",
-                "Press F to pay respects... to your dignity 📱💀",
-                "It's not a bug, it's a 'creative feature'! 🐛➡️✨",
-                "Big oof energy right there 💀",
-                "And I took that personally 😤✨"
-            ]
-            
-            await ctx.send(random.choice(memes))
+            await ctx.send(random.choice(self.memes))
         
         @self.bot.command(name='stats', help='Show bot statistics')
         async def bot_stats(ctx):
@@ -602,7 +2634,8 @@ class AIDiscordBot:
             
             embed.add_field(
                 name="Active Conversations",
-                value=len(self.conversations),
+                value=f"{len(self.conversations)} ({self.conversations.bytes / 1024 / 1024:.1f} MB, "
+                      f"{self.conversations.evictions} evicted, {self.conversations.expirations} expired)",
                 inline=True
             )
             
@@ -612,6 +2645,129 @@ class AIDiscordBot:
                 inline=True
             )
             
+            embed.add_field(
+                name="LLM Queue",
+                value=f"{self.admission.active}/{self.admission.limit} active, {self.admission.queue_depth}/{self.admission.max_queue} waiting",
+                inline=True
+            )
+            
+            recent_limits = " → ".join(str(limit) for _, limit, _ in list(self.concurrency.history)[-6:])
+            embed.add_field(
+                name="LLM Limit",
+                value=f"{self.concurrency.limit} ({self.concurrency.min_limit}-{self.concurrency.max_limit})" + (f"\nRecent: {recent_limits}" if recent_limits else ""),
+                inline=True
+            )
+            
+            embed.add_field(
+                name="Avg Queue Wait",
+                value=f"{self.admission.avg_wait * 1000:.0f} ms",
+                inline=True
+            )
+            
+            embed.add_field(
+                name="Shed Requests",
+                value=self.admission.shed,
+                inline=True
+            )
+            
+            breaker_icons = {CircuitBreaker.CLOSED: "🟢", CircuitBreaker.HALF_OPEN: "🟡", CircuitBreaker.OPEN: "🔴"}
+            embed.add_field(
+                name="LLM Backends",
+                value="\n".join(
+                    f"{breaker_icons[backend.breaker.state]} {backend.name}: {backend.active}/{backend.max_concurrency} busy, "
+                    f"{backend.requests} reqs, {(backend.latency or 0.0) * 1000:.0f} ms"
+                    for backend in self.backends
+                ) + f"\n{self.backends.trips} trips, {self.backends.short_circuited} instant replies",
+                inline=False
+            )
+            
+            now = time.monotonic()
+            embed.add_field(
+                name="API Keys",
+                value="\n".join(
+                    f"{'🚫' if not key.available(now) else '🔑'} {key.label}: "
+                    + (key.quarantine_reason if not key.available(now) else f"{1 - key.headroom(now):.0%} used, {key.requests} reqs")
+                    for backend in self.backends for key in backend.keys
+                )[:1024],
+                inline=False
+            )
+            
+            if self.durable:
+                embed.add_field(
+                    name="Durable Store",
+                    value=f"{self.durable.writes} writes in {self.durable.batches} batches, "
+                          f"{self.durable.pending} queued, {self.durable.loads} loads, {self.durable.errors} errors",
+                    inline=True
+                )
+            
+            if self.snapshots:
+                embed.add_field(
+                    name="Snapshots",
+                    value=f"{self.snapshots.saves} saved, last {self.snapshots.last_size / 1024 / 1024:.1f} MB "
+                          f"in {self.snapshots.last_save_time * 1000:.0f} ms",
+                    inline=True
+                )
+            
+            embed.add_field(
+                name="Generations",
+                value=f"{len(self.generations)} in flight, {self.generations.cancelled} cancelled",
+                inline=True
+            )
+            
+            embed.add_field(
+                name="Cut Short Replies",
+                value=self.cut_short if self.partial_responses else "Off",
+                inline=True
+            )
+            
+            embed.add_field(
+                name="Hedging",
+                value=f"{self.hedging.hedge_rate:.1%} hedged, {self.hedging.win_rate:.0%} won" if self.hedging.enabled else "Off",
+                inline=True
+            )
+            
+            embed.add_field(
+                name="Coalesced Prompts",
+                value=f"{self.single_flight.saved} calls saved",
+                inline=True
+            )
+            
+            embed.add_field(
+                name="Response Cache",
+                value=f"{self.response_cache.hit_ratio:.0%} hit rate, {len(self.response_cache.entries)} entries ({self.response_cache.bytes / 1024:.0f} KiB), {self.response_cache.evictions} evicted\nSemantic: {self.semantic_cache.hit_ratio:.0%} hit rate, {self.semantic_cache.entries} entries, {self.semantic_cache.evictions} evicted",
+                inline=True
+            )
+            
+            route_lines = [
+                f"{route.name} ({route.model}): {route.requests} req, {route.avg_latency:.1f}s avg, {route.avg_tokens:.0f} tok/req"
+                for route in self.router.routes if route.requests
+            ]
+            prompt_tokens = sum(route.prompt_tokens for route in self.router.routes)
+            cached_tokens = sum(route.cached_tokens for route in self.router.routes)
+            embed.add_field(
+                name="Prompt Prefix",
+                value=f"{self.prefix_tracker.stability:.0%} stable, {cached_tokens / prompt_tokens if prompt_tokens else 0:.0%} of prompt tokens cached",
+                inline=True
+            )
+            
+            embed.add_field(
+                name="Banter Pool",
+                value=f"{self.banter_pool.ready} ready, {self.banter_pool.hit_rate:.0%} hit rate",
+                inline=True
+            )
+            
+            embed.add_field(
+                name="Model Routes",
+                value="\n".join(route_lines) or "No completions yet",
+                inline=False
+            )
+            
+            embed.add_field(
+                name="OpenAI Retries",
+                value=f"{self.retry_policy.retried} retried, {self.retry_policy.recovered} recovered, {self.retry_policy.failed} gave up",
+                inline=True
+            )
+            
             embed.add_field(
                 name="Teacher DM",
                 value="✅ Enabled" if self.teacher_dm_enabled else "❌ Disabled",
@@ -634,48 +2790,597 @@ class AIDiscordBot:
             
             await ctx.send(embed=embed)
     
-    async def get_jyle_response(self, conversation_history: list, username: str, channel_id: str, ctx) -> str:
-        """Get response from OpenAI API with Jyle's personality"""
+    def history_budget(self) -> int:
+        """Tokens a channel's history may use once the system prompt and reply are reserved"""
+        max_reply = max(route.max_tokens for route in self.router.routes)
+        return min(self.history_token_budget, self.context_window - max_reply - self.system_prompt_reserve)
+    
+    def conversation_key(self, ctx) -> str:
+        """Conversation history key for a command, following conversation_scope"""
+        channel_id = str(ctx.channel.id)
+        if self.conversation_scope == 'user' or (
+            self.conversation_scope == 'thread' and not isinstance(ctx.channel, discord.Thread)
+        ):
+            return f"{channel_id}:{ctx.author.id}"
+        return channel_id
+    
+    async def conversation(self, key: str) -> ConversationHistory:
+        """A conversation's history, read back from the durable store the first time it's needed"""
+        history = self.conversations.get(key)
+        if history is not None or self.durable is None:
+            return history if history is not None else self.conversations.get_or_create(key)
+        
+        persona, summary, turns = await self.durable.load(key)
+        history = self.conversations.get(key)
+        if history is not None:
+            return history  # another command loaded or reset it while we waited
+        
+        history = ConversationHistory(persona=persona)
+        if summary:
+            history.set_summary(summary)
+        for seq, role, content in turns:
+            history.append(role, content)
+        if turns:
+            history.seq = turns[-1][0]
+        history.trim(self.history_budget())  # older turns are already covered by the summary
+        self.conversations[key] = history
+        return history
+    
+    def append_turn(self, key: str, history: ConversationHistory, role: str, content: str) -> tuple:
+        """Append a turn and queue it for the durable store"""
+        turn = history.append(role, content)
+        if self.durable:
+            self.durable.append(key, history.seq, role, content)
+        return turn
+    
+    def remove_turn(self, key: str, history: ConversationHistory, turn: tuple):
+        if history.remove(turn) and self.durable:
+            self.durable.remove(key, turn[1])
+    
+    def trim_history(self, channel_id: str, history: ConversationHistory):
+        """Trim a channel's history to the token budget, queueing dropped turns for summarizing"""
+        dropped = history.trim(self.history_budget())
+        if dropped and self.summaries_enabled:
+            history.evicted.extend(dropped)
+            del history.evicted[:-self.summary_max_evicted]
+            self.summarizer.mark(channel_id, history)
+    
+    def llm_idle(self) -> bool:
+        """True when OpenAI capacity is mostly unused, so background work won't slow anyone down"""
+        return self.admission.queue_depth == 0 and self.admission.active <= self.admission.limit // 4
+    
+    async def generate_banter(self, key, count: int) -> list:
+        """Generate a batch of banter lines for a (sass level, roast mode) pool with one completion"""
+        sass_level, roast_mode = key
+        response = await self.background_completion(
+            'banter',
+            messages=[
+                {"role": "system", "content": self.personalities[roast_mode]},
+                {
+                    "role": "user",
+                    "content": f"Write {count} different short, witty one-liners of random banter for a Discord chat. Sass level: {sass_level}. Reply with a JSON object like {{\"banter\": [\"...\"]}}."
+                }
+            ],
+            max_tokens=60 * count,
+            temperature=1.0,
+            response_format={"type": "json_object"},
+        )
+        lines = json.loads(response.choices[0].message.content).get("banter", [])
+        return [str(line).strip() for line in lines if str(line).strip()][:count]
+    
+    async def background_completion(self, key: str, **kwargs):
+        """One-off completion for background work (summaries, banter) on whichever backend is picked"""
+        backend = self.backends.choose()
+        async with self.admission.slot(key), backend.slot():
+            api_key = backend.keys.choose(self.estimate_request_tokens(kwargs["messages"], kwargs.get("max_tokens", 0)))
+            try:
+                started = time.monotonic()
+                raw = await api_key.client.chat.completions.with_raw_response.create(
+                    model=backend.model_for(self.ai_model),
+                    **kwargs
+                )
+            except Exception as e:
+                backend.record_error(api_key, e)
+                raise
+        backend.record_success(time.monotonic() - started)
+        api_key.observe(raw.headers)
+        return raw.parse()
+    
+    @staticmethod
+    def estimate_request_tokens(messages: list, max_tokens: int) -> int:
+        """What a request counts against a tokens-per-minute budget: prompt estimate plus max_tokens"""
+        return sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+    
+    async def summarize_histories(self, batch: list):
+        """Fold each channel's evicted turns into its running summary with one completion call"""
+        if not self.backends.allow():
+            raise CircuitOpen()
+        
+        pending = {channel_id: (history, history.evicted) for channel_id, history in batch}
+        payload = {
+            channel_id: {
+                "summary_so_far": history.summary_text,
+                "new_messages": [f"{role}: {content}" for role, content, _ in evicted]
+            }
+            for channel_id, (history, evicted) in pending.items()
+        }
+        for history, _ in pending.values():
+            history.evicted = []
+        
+        try:
+            response = await self.background_completion(
+                'summarizer',
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "You keep short running summaries of Discord conversations. For every channel id in the JSON input, merge new_messages into summary_so_far, keeping names, open questions and key facts. At most 60 words per summary. Reply with a JSON object mapping each channel id to its new summary."
+                    },
+                    {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
+                ],
+                max_tokens=120 * len(payload),
+                temperature=0.2,
+                response_format={"type": "json_object"},
+            )
+            summaries = json.loads(response.choices[0].message.content)
+            if not isinstance(summaries, dict):
+                raise ValueError(f"summarizer returned a JSON {type(summaries).__name__}, not an object")
+        except Exception:
+            for history, evicted in pending.values():
+                history.evicted[:0] = evicted  # keep them for the next attempt
+            raise
+        
+        for channel_id, (history, evicted) in pending.items():
+            entry = self.conversations.entries.get(channel_id)
+            if entry is None or entry[0] is not history:
+                continue  # cleared, replaced by !persona or evicted while we were summarizing
+            if isinstance(summaries.get(channel_id), str):
+                history.set_summary(summaries[channel_id])
+                if self.durable:
+                    self.durable.set_channel(channel_id, history.persona, history.summary_text)
+            else:
+                history.evicted[:0] = evicted
+                self.summarizer.mark(channel_id, history)  # try again next flush
+    
+    def streaming_reply(self, ctx, embed_factory=None) -> StreamingReply:
+        """Create a progressively edited reply using the bot's streaming settings"""
+        return StreamingReply(
+            ctx,
+            edit_interval=self.stream_edit_interval,
+            edit_chars=self.stream_edit_chars,
+            limit=4096 if embed_factory else 2000,
+            embed_factory=embed_factory
+        )
+    
+    async def get_jyle_response(self, conversation_history: list, username: str, channel_id: str, ctx, on_delta=None,
+                                conversation_key: str = None) -> str:
+        """Get response from OpenAI API with Jyle's personality
+        
+        conversation_key identifies the history being continued (see conversation_key());
+        it defaults to the channel. If on_delta is given the completion is streamed and on_delta is awaited with the
+        accumulated text every time new tokens arrive. With partial_responses on, the
+        completion is always streamed so the text so far can be sent if the command's
+        deadline passes or the stream breaks.
+        """
+        partial = ""
+        conversation_key = conversation_key or channel_id
+        
+        async def collect(text):
+            nonlocal partial
+            partial = text
+            if on_delta:
+                await on_delta(text)
+        
+        command = ctx.command.name if getattr(ctx, 'command', None) else None
+        slo = self.command_deadlines.get(command, self.llm_deadline)
         try:
             # Get user's nickname if they have one
             display_name = self.user_nicknames.get(str(ctx.author.id), username)
             
             roast_mode = self.roast_mode.get(channel_id, False)
             
-            if roast_mode:
-                personality = f"You are Jyle, a sassy, witty AI assistant with a playful roasting personality. You love friendly banter and gentle teasing, but you're never truly mean. You use humor, tech jokes, and clever comebacks. Keep it fun and lighthearted. The user you're talking to is {display_name}."
+            shared = command in self.coalesce_commands
+            if shared:
+                messages = self.shared_messages(conversation_history, username, roast_mode)
             else:
-                personality = f"You are Jyle, a fun, engaging AI assistant who loves banter and humor. You're witty but friendly, use tech jokes and memes when appropriate, and have a playful personality. You occasionally throw in some gentle teasing but always stay positive. The user you're talking to is {display_name}."
+                messages = self.build_messages(conversation_history, display_name, roast_mode)
+                self.prefix_tracker.observe(conversation_key, messages)
             
-            system_message = {
-                "role": "system",
-                "content": personality
-            }
-            
-            messages = [system_message] + conversation_history # FIX: Combine system message and history
+            route = self.router.route(command, self.latest_prompt(conversation_history, username))
             
-            # OpenAI API call
-            response = await asyncio.to_thread(
-                self.openai_client.chat.completions.create,
-                model=self.ai_model,
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-            )
+            deadline = time.monotonic() + slo
+            cache_key = None
+            semantic_vector = None
+            guild_id = ctx.guild.id if ctx.guild else None
+            persona = self.persona_of(conversation_history)
+            semantic_namespace = (guild_id, conversation_key, route.model, roast_mode, persona)
+            if command in self.cache_commands or channel_id in self.cache_channels:
+                cache_key = ResponseCache.make_key(messages, route.model, route.temperature, roast_mode)
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+                if self.semantic_cache_enabled:
+                    try:
+                        cached, semantic_vector = await asyncio.wait_for(
+                            self.semantic_cache.get(semantic_namespace, self.latest_prompt(conversation_history, username)),
+                            min(self.semantic_embed_timeout, deadline - time.monotonic())
+                        )
+                    except Exception as e:
+                        # Embeddings are an optimization; without them it's just a cache miss
+                        logger.warning(f"Semantic cache lookup failed, treating it as a miss: {e!r}")
+                        cached = None
+                    if cached is not None:
+                        return cached
             
-            ai_response = response.choices[0].message.content
+            on_text = collect if on_delta or self.partial_responses else None
+            if shared:
+                completion = self.single_flight.do(
+                    self.prompt_fingerprint(conversation_history, username, roast_mode, route),
+                    lambda delta: self.complete_with_retries(messages, route, guild_id, deadline, delta),
+                    on_text
+                )
+            else:
+                completion = self.complete_with_retries(messages, route, guild_id, deadline, on_text)
+            ai_response = await asyncio.wait_for(completion, deadline - time.monotonic())
+            if cache_key and ai_response:
+                self.response_cache.put(cache_key, ai_response)
+            if semantic_vector is not None and ai_response:
+                self.semantic_cache.put(semantic_namespace, semantic_vector, ai_response)
             return ai_response
             
+        except asyncio.TimeoutError:
+            logger.warning(f"LLM request from channel {channel_id} missed its {slo:.0f}s deadline ({len(partial)} chars in)")
+            if self.partial_responses and partial.strip():
+                return self.cut_short_reply(partial)
+            return "⏰ Ugh, OpenAI is being SLOW and I refuse to keep you waiting any longer. Try again in a bit! 💅"
+        except CircuitOpen:
+            return self.degraded_reply()
+        except AdmissionRejected as e:
+            logger.warning(f"Shed LLM request from channel {channel_id}: {e} ({self.admission.queue_depth} waiting)")
+            return f"I'm absolutely swamped right now! 😵‍💫 Everyone wants a piece of Jyle - try again in {e.retry_after}s 💅"
         except openai.APIError as e:
             logger.error(f"OpenAI API Error: {e}")
+            if self.partial_responses and partial.strip():
+                return self.cut_short_reply(partial)
             return "Uh oh, my circuits are a bit fried right now! OpenAI isn't responding. Please try again later. 😵‍💫"
         except Exception as e:
             logger.error(f"Error getting AI response: {e}")
+            if self.partial_responses and partial.strip():
+                return self.cut_short_reply(partial)
             return "Oops! I encountered an unexpected error while trying to respond. My apologies! 😅"
 
+    def cut_short_reply(self, partial: str) -> str:
+        """The text streamed so far, marked as cut short"""
+        self.cut_short += 1
+        return partial.rstrip() + self.cut_short_marker
+
+    async def complete_with_retries(self, messages: list, route: Route, guild_id, deadline: float, on_delta=None) -> str:
+        """Run a completion under the admission controller, retrying transient failures until the deadline
+        
+        The admission slot is only held during an attempt, not while backing off. Once any
+        text has been streamed to Discord the request is no longer retried.
+        """
+        streamed = False
+        
+        async def track_delta(text):
+            nonlocal streamed
+            streamed = True
+            await on_delta(text)
+        
+        tried = set()  # backends already used, so a retry fails over to another one if it can
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.backends.allow():
+                raise CircuitOpen()
+            try:
+                async with self.admission.slot(guild_id):
+                    result = await self.hedged_completion(
+                        messages,
+                        route,
+                        track_delta if on_delta else None,
+                        timeout=deadline - time.monotonic(),
+                        tried=tried
+                    )
+                self.retry_policy.record(attempt, "ok")
+                return result
+            except Exception as e:
+                outcome = self.retry_policy.classify(e)
+                if outcome is None or streamed:
+                    if not isinstance(e, (AdmissionRejected, CircuitOpen)):
+                        self.retry_policy.record(attempt, "error")
+                    raise
+                delay = self.retry_policy.delay(attempt, self.retry_policy.retry_after(e))
+                if attempt >= self.retry_policy.max_attempts:
+                    self.retry_policy.record(attempt, f"gave up ({outcome})")
+                    raise
+                if time.monotonic() + delay >= deadline:
+                    self.retry_policy.record(attempt, f"gave up ({outcome}, deadline)")
+                    raise
+                self.retry_policy.record(attempt, f"retry ({outcome})")
+                logger.warning(f"OpenAI attempt {attempt} failed ({outcome}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+    
+    def build_messages(self, conversation_history: list, display_name: str, roast_mode: bool) -> list:
+        """Assemble the prompt, most stable parts first
+        
+        Personality, persona and summary come first and are byte-identical between calls,
+        then the channel history (append-only between trims), and the per-user detail goes
+        last so it never breaks the cacheable prefix.
+        """
+        return (
+            [{"role": "system", "content": self.personalities[roast_mode]}]
+            + conversation_history
+            + [{"role": "system", "content": f"The user you're talking to is {display_name}."}]
+        )
+    
+    def shared_messages(self, conversation_history: list, username: str, roast_mode: bool) -> list:
+        """History-free prompt for coalesced commands, so one reply fits every caller who asked the same thing"""
+        persona = self.persona_of(conversation_history)
+        return (
+            [{"role": "system", "content": self.personalities[roast_mode]}]
+            + ([{"role": "system", "content": persona}] if persona else [])
+            + [
+                {"role": "system", "content": "Several students may be asking this same question, so answer it for all of them without addressing anyone by name."},
+                {"role": "user", "content": self.latest_prompt(conversation_history, username)}
+            ]
+        )
+    
+    @staticmethod
+    def persona_of(conversation_history: list) -> str:
+        """The channel's !persona system message, if it has one"""
+        return next((
+            message["content"] for message in conversation_history
+            if message["role"] == "system" and not message["content"].startswith(ConversationHistory.SUMMARY_PREFIX)
+        ), "")
+    
+    @staticmethod
+    def latest_prompt(conversation_history: list, username: str) -> str:
+        """The newest message's text without the "username: " prefix the commands add"""
+        prompt = conversation_history[-1]["content"] if conversation_history else ""
+        return prompt.removeprefix(f"{username}: ")
+    
+    def prompt_fingerprint(self, conversation_history: list, username: str, roast_mode: bool, route: Route) -> str:
+        """Key for coalescing identical prompts: the normalized latest message plus route, persona and roast mode
+        
+        That is everything shared_messages() puts in the prompt, so callers with the same
+        fingerprint would have sent the same request.
+        """
+        prompt = self.latest_prompt(conversation_history, username)
+        normalized = " ".join(re.sub(r"[^\w\s]", "", prompt.lower()).split())
+        persona = self.persona_of(conversation_history)
+        return hashlib.sha256(f"{route.name}|{route.model}|{roast_mode}|{persona}|{normalized}".encode()).hexdigest()
+    
+    def degraded_reply(self) -> str:
+        """Instant canned reply used while every backend's circuit breaker is open"""
+        return f"🔌 My AI brain is taking a dramatic little break (OpenAI is down), but I refuse to leave you empty-handed:\n\n{random.choice(self.memes)}"
+    
+    def make_backend(self, spec: dict) -> LLMBackend:
+        """Build an LLM backend from a backend_specs row; every backend and key shares the HTTP connection pool"""
+        keys = []
+        for number, (api_key, rpm, tpm) in enumerate(spec.get("api_keys") or [(None, self.key_default_rpm, self.key_default_tpm)], 1):
+            if spec.get("base_url") == self.openai_base_url and api_key == self.openai_api_key:
+                client = self.openai_client
+            else:
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=spec.get("base_url"),
+                    http_client=self.http_client,
+                    max_retries=0
+                )
+            keys.append(ApiKey(f"{spec['name']}#{number} (...{(api_key or '')[-4:]})", client, rpm=rpm, tpm=tpm))
+        return LLMBackend(
+            spec["name"],
+            KeyPool(keys, quarantine_time=self.key_quarantine_time),
+            max_concurrency=spec.get("max_concurrency", 8),
+            weight=spec.get("weight", 1.0),
+            model=spec.get("model"),
+            probe_model=self.ai_model
+        )
+    
+    async def hedged_completion(self, messages: list, route: Route, on_delta=None, timeout=None, tried=None) -> str:
+        """Run a completion, racing a backup request if the first one is slow to respond
+        
+        Whichever request responds first (first streamed token, or the full response)
+        wins; the other is cancelled so we stop paying for it. The backup goes to another
+        backend when there is one.
+        """
+        tried = tried if tried is not None else set()
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        decided = loop.create_future()  # resolves to the index of the winning request
+        tasks = []
+        failures = []
+        
+        def claim(index):
+            if not decided.done():
+                decided.set_result(index)
+        
+        def forward(index):
+            async def delta(text):
+                claim(index)
+                if decided.result() == index:
+                    await on_delta(text)
+            return delta
+        
+        async def run(index):
+            try:
+                result = await self.request_completion(messages, route, forward(index) if on_delta else None, timeout, tried)
+            except Exception as e:
+                failures.append(e)
+                if len(failures) == len(tasks) and not decided.done():
+                    decided.set_exception(e)
+                raise
+            claim(index)
+            return result
+        
+        def launch(index):
+            task = asyncio.create_task(run(index))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            tasks.append(task)
+        
+        self.hedging.requests += 1
+        launch(0)
+        try:
+            threshold = self.hedging.threshold()
+            if threshold is not None:
+                done, _ = await asyncio.wait({decided}, timeout=threshold)
+                if not done and self.hedging.allow():
+                    self.hedging.hedges += 1
+                    logger.info(f"Hedging slow OpenAI request (no response after {threshold:.1f}s)")
+                    launch(1)
+            winner = await decided
+            self.hedging.samples.append(time.monotonic() - started)
+            if winner == 1:
+                self.hedging.wins += 1
+            for index, task in enumerate(tasks):
+                if index != winner:
+                    task.cancel()  # hang up on the loser now, not once the winner has finished
+            return await tasks[winner]
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def request_completion(self, messages: list, route: Route, on_delta=None, timeout=None, tried=None) -> str:
+        """Run one chat completion with the route's settings, streaming it through on_delta when given
+        
+        The backend is picked by self.backends, avoiding the ones in tried, and the API
+        key by the backend's key pool. Every call feeds the adaptive concurrency limit:
+        time until the response headers arrive, the keys' rate-limit headroom, and any 429s. Completed calls record their latency
+        and token usage on the route.
+        """
+        backend = self.backends.choose(exclude=tried or ())
+        if tried is not None:
+            tried.add(backend.name)
+        stream = on_delta is not None
+        async with backend.slot():
+            api_key = backend.keys.choose(self.estimate_request_tokens(messages, route.max_tokens))
+            started = time.monotonic()
+            try:
+                raw = await api_key.client.chat.completions.with_raw_response.create(
+                    model=backend.model_for(route.model),
+                    messages=messages,
+                    max_tokens=route.max_tokens,
+                    temperature=route.temperature,
+                    stream=stream,
+                    stream_options={"include_usage": True} if stream else openai.NOT_GIVEN,
+                    timeout=max(0.1, timeout) if timeout is not None else openai.NOT_GIVEN,
+                )
+            except Exception as e:
+                outcome = backend.record_error(api_key, e)
+                if outcome == "429":
+                    self.concurrency.on_throttled()
+                elif outcome == "timeout":
+                    self.concurrency.on_overloaded("timeout")
+                raise
+            backend.record_success(time.monotonic() - started)
+            api_key.observe(raw.headers)
+            self.concurrency.on_success(time.monotonic() - started, backend.keys.headroom(), backend.name)
+            
+            if not stream:
+                response = raw.parse()
+                route.record(time.monotonic() - started, response.usage)
+                return response.choices[0].message.content
+            
+            ai_response = ""
+            usage = None
+            chunks = raw.parse()
+            try:
+                async for chunk in chunks:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        ai_response += chunk.choices[0].delta.content
+                        await on_delta(ai_response)
+            finally:
+                await chunks.close()  # if we were cancelled, hang up so the server stops generating
+            route.record(time.monotonic() - started, usage)
+            return ai_response
+    
+    def collect_state(self) -> dict:
+        """Everything a warm restart needs, as plain data for StateSnapshot"""
+        return {
+            'conversations': [(key, history.dump(), idle) for key, history, idle in self.conversations.items()],
+            'nicknames': dict(self.user_nicknames),
+            'roast_mode': [channel_id for channel_id, enabled in self.roast_mode.items() if enabled],
+            'cache_channels': list(self.cache_channels),
+            'teacher_id': self.teacher_id_override,
+            'teacher_id_env': os.getenv('TEACHER_DISCORD_ID'),
+            'teacher_dm_enabled': self.teacher_dm_enabled,
+        }
+    
+    def restore_state(self):
+        """Load the last snapshot, if any, before the bot connects"""
+        started = time.perf_counter()
+        with paused_gc():
+            state = self.snapshots.read()
+            if state is None:
+                return
+            self.conversations.load(
+                (key, ConversationHistory.restore(history), idle) for key, history, idle in state['conversations']
+            )
+        self.user_nicknames.update(state['nicknames'])
+        self.roast_mode.update(dict.fromkeys(state['roast_mode'], True))
+        self.cache_channels.update(state['cache_channels'])
+        # A teacher picked with !set_teacher survives restarts, but a changed TEACHER_DISCORD_ID wins
+        env_teacher = os.getenv('TEACHER_DISCORD_ID')
+        if state['teacher_id'] and (not env_teacher or env_teacher == state.get('teacher_id_env')):
+            self.teacher_id = self.teacher_id_override = state['teacher_id']
+        elif state['teacher_id']:
+            logger.warning(f"TEACHER_DISCORD_ID changed since the snapshot, ignoring teacher {state['teacher_id']} set with !set_teacher")
+        self.teacher_dm_enabled = state['teacher_dm_enabled']
+        logger.info(f"Restored {len(state['conversations'])} conversations and {len(state['nicknames'])} nicknames "
+                    f"from {self.snapshot_path} in {(time.perf_counter() - started) * 1000:.0f} ms")
+    
+    def load_durable_settings(self):
+        """Restore nicknames and roast mode from the durable store"""
+        self.user_nicknames.update(self.durable.load_settings('nickname'))
+        self.roast_mode.update({channel_id: True for channel_id in self.durable.load_settings('roast_mode')})
+        logger.info(f"Restored {len(self.user_nicknames)} nicknames and {len(self.roast_mode)} roast mode channels from {self.durable_path}")
+    
+    async def start(self):
+        """Start the bot and release shared resources on shutdown"""
+        try:
+            async with self.bot:
+                if self.snapshots:
+                    self.restore_state()
+                    self.snapshots.start()
+                if self.durable:
+                    self.load_durable_settings()
+                    self.durable.start()
+                self.summarizer.start()
+                self.banter_pool.start()
+                self.backends.start()
+                self.conversations.start()
+                await self.bot.start(self.bot_token)
+        finally:
+            await self.close()
+    
+    async def close(self):
+        """Close the Discord connection and the shared OpenAI connection pool"""
+        if not self.bot.is_closed():
+            await self.bot.close()
+        self.backends.stop()
+        self.summarizer.stop()
+        self.banter_pool.stop()
+        self.conversations.stop()
+        if self.snapshots:
+            self.snapshots.stop()
+            try:
+                await self.snapshots.save()
+            except Exception as e:
+                logger.error(f"Final snapshot to {self.snapshot_path} failed: {e}")
+        if self.durable:
+            await self.durable.close()
+            logger.info(f"Durable store flushed ({self.durable.writes} writes in {self.durable.batches} batches)")
+        await self.openai_client.close()
+        logger.info("OpenAI connection pool closed")
+    
     def run(self):
         """Run the bot"""
-        self.bot.run(self.bot_token)
+        try:
+            asyncio.run(self.start())
+        except KeyboardInterrupt:
+            logger.info("Jyle is leaving the stage... dramatically 🎭")
 
 if __name__ == "__main__":
     bot_instance = AIDiscordBot()